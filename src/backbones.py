@@ -0,0 +1,47 @@
+# backbones.py -- Registry of the convolutional feature extractors the
+#   sequence models (model.rnn_layers, model.seqconv_layers) can sit on.
+#
+# Each backbone bundles
+#   layers_fn  : layers_fn( inputs, widths, mode ) -> features, sequence_length
+#                with features of shape [batch, paddedSeqLen, depth]
+#   seq_len_fn : the width -> sequence length function of those layers
+#                (also used by the input filters)
+#   scope      : variable scope of its variables (trainable by default)
+# and is selected by name, e.g. train.py --backbone=densenet
+
+import collections
+import functools
+import model
+import denseNet
+
+Backbone = collections.namedtuple( 'Backbone',
+                                   [ 'layers_fn', 'seq_len_fn', 'scope' ] )
+
+_backbones = collections.OrderedDict( [
+    ( 'convnet', Backbone( model.convnet_layers,
+                           model.get_sequence_lengths,
+                           'convnet' ) ),
+    ( 'sepconv', Backbone( model.sepconv_layers,
+                           model.get_sequence_lengths,
+                           'sepconv' ) ),
+    ( 'densenet', Backbone( denseNet.Dense_net,
+                            denseNet.get_sequence_lengths,
+                            'densenet' ) ),
+    # Same variables as densenet, recomputing block intermediates in backprop
+    ( 'densenet_efficient', Backbone( functools.partial( denseNet.Dense_net,
+                                                         efficient=True ),
+                                      denseNet.get_sequence_lengths,
+                                      'densenet' ) ) ] )
+
+
+def names():
+    """Names of the registered backbones"""
+    return list( _backbones.keys() )
+
+
+def get_backbone( name ):
+    """The Backbone registered under name"""
+    if name not in _backbones:
+        raise ValueError( 'Unknown backbone %s (one of %s)' %
+                          ( name, ', '.join( names() ) ) )
+    return _backbones[name]
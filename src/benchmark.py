@@ -0,0 +1,330 @@
+# benchmark.py -- Throughput benchmarks for the input pipeline and model.
+#   Select one with --bench (use --help for options), e.g.
+#     python benchmark.py --bench=records --bench_path=../data/train/
+
+import os
+import shutil
+import tempfile
+import time
+import importlib
+import numpy as np
+import tensorflow as tf
+import backbones
+import charset
+import filters
+import model
+import mjsynth
+
+tfrecord = importlib.import_module( 'mjsynth-tfrecord' )
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string( 'bench','records',
+                            """Benchmark to run: records, labels, filters, rnn,
+                            memory, backbones""" )
+tf.app.flags.DEFINE_string( 'bench_path','../data/train/',
+                            """Base directory for benchmark data""" )
+tf.app.flags.DEFINE_string( 'filename_pattern','words-*',
+                            """File pattern for benchmark data""" )
+tf.app.flags.DEFINE_integer( 'num_input_threads',4,
+                             """Number of readers for input data""" )
+tf.app.flags.DEFINE_integer( 'max_elements',2**16,
+                             """Maximum number of elements to time""" )
+tf.app.flags.DEFINE_integer( 'batch_size',32,
+                             """Mini-batch size for batched benchmarks""" )
+tf.app.flags.DEFINE_integer( 'min_image_width',32,
+                             """Minimum image width for the filters benchmark""" )
+tf.app.flags.DEFINE_integer( 'max_image_width',512,
+                             """Maximum image width for the filters benchmark""" )
+tf.app.flags.DEFINE_integer( 'min_string_length',1,
+                             """Minimum string length for the filters benchmark""" )
+tf.app.flags.DEFINE_integer( 'max_string_length',32,
+                             """Maximum string length for the filters benchmark""" )
+tf.app.flags.DEFINE_integer( 'num_steps',20,
+                             """Number of timed steps for model benchmarks""" )
+tf.app.flags.DEFINE_string( 'widths','32,64,96,128,160,192,224,256',
+                            """Image widths (bucket boundaries) for model
+                            benchmarks""" )
+
+
+def _time_dataset( dataset, max_elements, batch_size=256 ):
+    """Iterate over (at most max_elements of) a dataset of records.
+    Returns the number of elements and the elapsed seconds"""
+    dataset = dataset.take( max_elements ).batch( batch_size )
+    batch_count = tf.shape( dataset.make_one_shot_iterator().get_next() )[0]
+    count = 0
+    with tf.Session() as sess:
+        start = time.time()
+        try:
+            while True:
+                count += sess.run( batch_count )
+        except tf.errors.OutOfRangeError:
+            pass
+        seconds = time.time() - start
+    return count, seconds
+
+
+def _report( name, count, seconds, num_bytes=None ):
+    seconds = max( seconds, 1e-6 )
+    line = '%-12s %8d elements in %7.2fs: %9.1f elements/s' % \
+           ( name, count, seconds, count / seconds )
+    if num_bytes is not None:
+        line += ', %8.1f MB on disk (%.1f MB/s)' % \
+                ( num_bytes / 2**20, num_bytes / 2**20 / seconds )
+    print( line )
+
+
+def bench_records():
+    """Read throughput of uncompressed vs. GZIP vs. ZLIB shards.
+    Compressed copies of the selected shards are written to a temp dir"""
+    filenames = mjsynth._get_filenames( FLAGS.bench_path,
+                                        str.split( FLAGS.filename_pattern, ',' ) )
+    filenames = [f for f in filenames if mjsynth.get_compression_type( f ) == '']
+    if not filenames:
+        raise IOError( 'No uncompressed shards found in %s' % FLAGS.bench_path )
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for compression in [ '', 'GZIP', 'ZLIB' ]:
+            out_dir = os.path.join( tmp_dir, compression or 'NONE' )
+            os.mkdir( out_dir )
+            for filename in filenames:
+                out_filename = os.path.join( out_dir, os.path.basename( filename ) )
+                if not compression:
+                    os.symlink( os.path.abspath( filename ), out_filename )
+                    continue
+                writer = tfrecord.record_writer( out_filename, compression )
+                for record in tf.python_io.tf_record_iterator( filename ):
+                    writer.write( record )
+                writer.close()
+
+        for compression in [ '', 'GZIP', 'ZLIB' ]:
+            out_dir = os.path.join( tmp_dir, compression or 'NONE' )
+            num_bytes = sum( os.path.getsize( os.path.join( out_dir, f ) )
+                             for f in os.listdir( out_dir ) )
+            with tf.Graph().as_default():
+                dataset = mjsynth.get_dataset( ( out_dir, [ '*' ],
+                                                 FLAGS.num_input_threads,
+                                                 FLAGS.num_input_threads * 64 ) )
+                count, seconds = _time_dataset( dataset, FLAGS.max_elements )
+            _report( compression or 'NONE', count, seconds, num_bytes )
+    finally:
+        shutil.rmtree( tmp_dir )
+
+
+def _sparse_label_fn( data ):
+    """Parse a record the old way, carrying the labels as a serialized
+    SparseTensor through batching"""
+    features = tf.parse_single_example( data, mjsynth._feature_map )
+    image = tf.image.decode_jpeg( features['image/encoded'], channels=1 )
+    image = mjsynth.preprocess_image( image )
+    width = tf.cast( features['image/width'], tf.int32 )
+    label = tf.serialize_sparse( features['image/labels'] )
+    return image, width, label, features['text/length'], \
+        features['text/string']
+
+
+def _sparse_postbatch_fn( image, width, label, length, text ):
+    label = tf.cast( tf.deserialize_many_sparse( label, tf.int64 ), tf.int32 )
+    return image, label
+
+
+def _dense_postbatch_fn( image, width, label, length, text ):
+    features, label = mjsynth.postbatch_fn( image, width, label, length, text )
+    return features['image'], label
+
+
+def bench_labels():
+    """Training input throughput (images/s) with labels carried as serialized
+    sparse tensors vs. dense padded tensors, through parse, decode,
+    padded_batch and the postbatch sparsification for ctc_loss"""
+    paths = [ ( 'sparse', _sparse_label_fn, _sparse_postbatch_fn ),
+              ( 'dense', mjsynth.preprocess_fn, _dense_postbatch_fn ) ]
+    for name, map_fn, postbatch_fn in paths:
+        with tf.Graph().as_default():
+            dataset = mjsynth.get_dataset( ( FLAGS.bench_path,
+                                             str.split( FLAGS.filename_pattern,
+                                                        ',' ),
+                                             FLAGS.num_input_threads,
+                                             FLAGS.num_input_threads * 64 ) )
+            dataset = dataset.take( FLAGS.max_elements )
+            dataset = dataset.map( map_fn,
+                                   num_parallel_calls=FLAGS.num_input_threads )
+            dataset = dataset.padded_batch( FLAGS.batch_size,
+                                            padded_shapes=dataset.output_shapes )
+            dataset = dataset.map( postbatch_fn,
+                                   num_parallel_calls=FLAGS.num_input_threads )
+            dataset = dataset.prefetch( 1 )
+            image, label = dataset.make_one_shot_iterator().get_next()
+            batch_count = tf.shape( image )[0]
+            # Touch the label values so their construction is not pruned
+            label_sum = tf.reduce_sum( label.values )
+            count = 0
+            with tf.Session() as sess:
+                start = time.time()
+                try:
+                    while True:
+                        count += sess.run( [ batch_count, label_sum ] )[0]
+                except tf.errors.OutOfRangeError:
+                    pass
+                seconds = time.time() - start
+        _report( name, count, seconds )
+
+
+def bench_filters():
+    """Throughput of the input filter on the decoded examples (after 
+    preprocess_fn) vs. pushed down before the JPEG decode (parse_fn, 
+    filter, decode_fn), and without a filter for reference. Counts are the
+    examples kept out of the first max_elements records"""
+    filter_fn = filters.input_filter_fn( 
+        min_image_width=FLAGS.min_image_width,
+        max_image_width=FLAGS.max_image_width,
+        min_string_length=FLAGS.min_string_length,
+        max_string_length=FLAGS.max_string_length,
+        check_input=True )
+    num_threads = FLAGS.num_input_threads
+    for name in [ 'unfiltered', 'after_decode', 'pushdown' ]:
+        with tf.Graph().as_default():
+            dataset = mjsynth.get_dataset( ( FLAGS.bench_path,
+                                             str.split( FLAGS.filename_pattern,
+                                                        ',' ),
+                                             num_threads,
+                                             num_threads * 64 ) )
+            dataset = dataset.take( FLAGS.max_elements )
+            if name == 'pushdown':
+                dataset = dataset.map( mjsynth.parse_fn,
+                                       num_parallel_calls=num_threads )
+                dataset = dataset.filter( filter_fn )
+                dataset = dataset.map( mjsynth.decode_fn,
+                                       num_parallel_calls=num_threads )
+            else:
+                dataset = dataset.map( mjsynth.preprocess_fn,
+                                       num_parallel_calls=num_threads )
+                if name == 'after_decode':
+                    dataset = dataset.filter( filter_fn )
+            # Batchable stand-in that still depends on the decoded image
+            dataset = dataset.map( lambda image, width, *rest: 
+                                   tf.concat( [ width, tf.shape( image ) ], 0 ) )
+            count, seconds = _time_dataset( dataset, FLAGS.max_elements )
+        _report( name, count, seconds )
+
+
+def _time_fetch( fetch, feed_dict, num_steps ):
+    """Seconds per run of fetch, after one untimed warm-up run"""
+    with tf.Session() as sess:
+        sess.run( tf.global_variables_initializer() )
+        sess.run( fetch, feed_dict )
+        start = time.time()
+        for _ in range( num_steps ):
+            sess.run( fetch, feed_dict )
+        return ( time.time() - start ) / num_steps
+
+
+def _get_widths():
+    return [ int( w ) for w in str.split( FLAGS.widths, ',' ) if w ]
+
+
+def bench_rnn():
+    """Forward throughput (sequences/s) of the RNN layers with the dynamic
+    (CudnnCompatibleLSTMCell) and fused (LSTMBlockFusedCell) implementations
+    and of the seqconv head at each image width. 
+    Set CUDA_VISIBLE_DEVICES= for CPU numbers"""
+    for width in _get_widths():
+        seq_len = width // 2 - 3 # as model.get_sequence_lengths
+        features = np.random.randn( FLAGS.batch_size, seq_len, 
+                                    model.layer_params[-1][0] )
+        for rnn_impl in model.rnn_impls + [ 'seqconv' ]:
+            with tf.Graph().as_default():
+                inputs = tf.placeholder( tf.float32, features.shape )
+                sequence_length = tf.fill( [ FLAGS.batch_size ], seq_len )
+                if rnn_impl == 'seqconv':
+                    logits = model.seqconv_layers( inputs, sequence_length,
+                                                   charset.num_classes() )
+                else:
+                    logits = model.rnn_layers( inputs, sequence_length,
+                                               charset.num_classes(), 
+                                               rnn_impl )
+                seconds = _time_fetch( logits, { inputs: features },
+                                       FLAGS.num_steps )
+            _report( '%s@%d' % ( rnn_impl, width ), FLAGS.batch_size,
+                     seconds )
+
+
+def _peak_memory( run_metadata ):
+    """Largest peak allocation of any allocator in a traced step, in bytes"""
+    peak = 0
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            for memory in node_stats.memory:
+                peak = max( peak, memory.peak_bytes )
+    return peak
+
+
+def bench_memory():
+    """Peak memory and time of a training step (forward and backward) of the
+    densenet backbone with and without recomputation, at each image width"""
+    for width in _get_widths():
+        images = np.random.rand( FLAGS.batch_size, 32, width, 1 ) - 0.5
+        for name in [ 'densenet', 'densenet_efficient', 'convnet' ]:
+            with tf.Graph().as_default():
+                inputs = tf.placeholder( tf.float32, images.shape )
+                widths = tf.fill( [ FLAGS.batch_size ], width )
+                features, _ = backbones.get_backbone( name ).layers_fn(
+                    inputs, widths, tf.estimator.ModeKeys.TRAIN )
+                loss = tf.reduce_sum( features )
+                grads = tf.gradients( loss, tf.trainable_variables() )
+                feed_dict = { inputs: images }
+                seconds = _time_fetch( grads, feed_dict, FLAGS.num_steps )
+                with tf.Session() as sess:
+                    sess.run( tf.global_variables_initializer() )
+                    run_metadata = tf.RunMetadata()
+                    sess.run( grads, feed_dict,
+                              options=tf.RunOptions( 
+                                  trace_level=tf.RunOptions.FULL_TRACE ),
+                              run_metadata=run_metadata )
+            print( '%-20s width %4d: peak %8.1f MB, %7.1f ms/step' %
+                   ( name, width, _peak_memory( run_metadata ) / 2.0**20,
+                     1000 * seconds ) )
+
+
+def _count_flops( graph ):
+    """Floating point operations of one run of the graph (static shapes)"""
+    builder = tf.profiler.ProfileOptionBuilder
+    # Only the total is wanted: keep the per-op profile off stdout
+    options = builder( builder.float_operation() ).with_empty_output().build()
+    profile = tf.profiler.profile( graph, options=options )
+    return profile.total_float_ops
+
+
+def bench_backbones():
+    """Inference FLOPs and latency of each backbone at each image width"""
+    for width in _get_widths():
+        images = np.random.rand( FLAGS.batch_size, 32, width, 1 ) - 0.5
+        for name in backbones.names():
+            with tf.Graph().as_default() as graph:
+                inputs = tf.placeholder( tf.float32, images.shape )
+                widths = tf.fill( [ FLAGS.batch_size ], width )
+                features, _ = backbones.get_backbone( name ).layers_fn(
+                    inputs, widths, tf.estimator.ModeKeys.PREDICT )
+                flops = _count_flops( graph )
+                seconds = _time_fetch( features, { inputs: images },
+                                       FLAGS.num_steps )
+            print( '%-20s width %4d: %8.2f GFLOPs/image, %7.1f ms/batch '
+                   '(%.1f images/s)' %
+                   ( name, width, flops / 1e9 / FLAGS.batch_size,
+                     1000 * seconds, FLAGS.batch_size / seconds ) )
+
+
+_benchmarks = { 'records': bench_records,
+                'labels': bench_labels,
+                'filters': bench_filters,
+                'rnn': bench_rnn,
+                'memory': bench_memory,
+                'backbones': bench_backbones }
+
+
+def main( argv=None ):
+    _benchmarks[FLAGS.bench]()
+
+if __name__ == '__main__':
+    tf.app.run()
@@ -18,9 +18,12 @@
 
 
 """ 
-The string of valid output characters for the model
+The list of valid output characters for the model, read from the compiled
+charset file (see word_dict.py) in a stable order
 Any example with a character not found here will generate a runtime error
 """
+import hashlib
+import numpy as np
 from word_dict import  load_dict
 out_charset=load_dict()
 
@@ -40,6 +43,17 @@ Produces a table of index->string mappings according to out_charset
 int_to_string_dict = dict(enumerate(out_charset))
 
 
+def charset_digest( strings ):
+    """Digest of the label indices of the characters in strings (-1 for
+    unknown ones): anything built from their labels (e.g. TFRecord shards)
+    should record it. Since the charset only grows, it changes only when
+    one of these characters is added"""
+    chars = sorted( set( ''.join( strings ) ) )
+    mapping = '\n'.join( '%s %d' % ( c, out_charset_dict.get( c, -1 ) )
+                         for c in chars )
+    return hashlib.sha1( mapping.encode( 'utf-8' ) ).hexdigest()
+
+
 def num_classes():
     """ Returns length/size of out_charset """
     return len( out_charset )
@@ -54,3 +68,67 @@ def string_to_label ( string ):
     """Convert a string to a list of labels"""
     label = [out_charset_dict[c] for c in string]
     return label
+
+
+class LabelCodec( object ):
+    """Batch string<->label conversion with NumPy lookup tables instead of
+    one list.index/dict lookup per character"""
+
+    def __init__( self, chars ):
+        self.chars = list( chars )
+        codepoints = np.array( [ord( c ) for c in self.chars], dtype=np.int64 )
+        # Table of codepoint->label; -1 marks characters outside the charset
+        self.code_to_label = np.full( codepoints.max() + 1 if len( codepoints ) else 1,
+                                      -1, dtype=np.int32 )
+        self.code_to_label[codepoints] = np.arange( len( codepoints ),
+                                                    dtype=np.int32 )
+        # Table of label->character
+        self.label_to_char = np.array( self.chars, dtype='<U1' )
+
+    def encode_batch( self, strings ):
+        """Convert a list of strings to flat labels plus offsets, so that the
+        labels of strings[i] are labels[offsets[i]:offsets[i+1]]"""
+        lengths = np.fromiter( (len( s ) for s in strings), dtype=np.int64,
+                               count=len( strings ) )
+        offsets = np.zeros( len( strings ) + 1, dtype=np.int64 )
+        np.cumsum( lengths, out=offsets[1:] )
+
+        codes = np.frombuffer( ''.join( strings ).encode( 'utf-32-le' ),
+                               dtype='<u4' )
+        known = codes < len( self.code_to_label )
+        labels = np.full( len( codes ), -1, dtype=np.int32 )
+        labels[known] = self.code_to_label[codes[known]]
+        if np.any( labels < 0 ):
+            missing = sorted( set( chr( c ) for c in codes[labels < 0] ) )
+            raise ValueError( 'Characters not in charset: %s' % ''.join( missing ) )
+        return labels, offsets
+
+    def encode( self, string ):
+        """Convert a string to an array of labels"""
+        labels, _ = self.encode_batch( [string] )
+        return labels
+
+    def decode_batch( self, labels, lengths=None ):
+        """Convert a list of label sequences (or a padded [batch, ?] array
+        with the given lengths) to a list of strings"""
+        if lengths is not None:
+            labels = [row[:n] for row, n in zip( labels, lengths )]
+        if len( labels ) == 0:
+            return []
+        lengths = [len( row ) for row in labels]
+        flat = np.concatenate( [np.asarray( row, dtype=np.int64 ).reshape( -1 )
+                                for row in labels] )
+        # One lookup for the whole batch, then split the joined text
+        text = ''.join( self.label_to_char[flat].tolist() )
+        offsets = np.cumsum( [0] + lengths )
+        return [text[offsets[i]:offsets[i+1]] for i in range( len( labels ) )]
+
+    def decode( self, labels ):
+        """Convert a sequence of labels to the corresponding string"""
+        return self.decode_batch( [labels] )[0]
+
+
+"""
+Codec for batch string<->label conversion according to out_charset
+"""
+codec = LabelCodec( out_charset )
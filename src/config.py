@@ -3,6 +3,8 @@ from pandas import Timestamp
 logging.basicConfig(format='%(asctime)s %(funcName)-20s: %(levelname)+8s: %(message)s', level=logging.INFO,)
 
 WORDDICT= '/home/yindong/PycharmProjects/ICPR_ChineseLineRecognization/data/train/ChineseChar'
+# Compiled charset (see word_dict.py), the single source of label indices
+CHARSET_FILE= '../data/train/charset.json'
 
 loglevel= logging.DEBUG
 log = logging.getLogger(name='global')
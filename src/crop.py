@@ -2,9 +2,13 @@ from PIL import Image
 import numpy as np
 import os
 import math
+import argparse
 import cv2
 import codecs
+import importlib
+from multiprocessing import Pool
 from config import  log
+from manifest import Manifest, file_digest
 
 
 def clock(coor):
@@ -19,81 +23,262 @@ def clock(coor):
 
     return coor[0], coor[1]
 
-def crop():
-    root_dir = '../data/originData'
+def get_dirs(root_dir='../data/originData'):
+    """Return the input and output directories of the crop stage"""
     text_dir = os.path.join(root_dir, 'txt_train')
     img_dir = os.path.join(root_dir, 'image_train')
     save_dir_hor = os.path.join(root_dir, 'crop_img_hor')
     save_dir_ver = os.path.join(root_dir, 'crop_img_ver')
+    return text_dir, img_dir, save_dir_hor, save_dir_ver
+
+def iter_lines(page, txt_path):
+    """Warp every annotated line of a page straight to the target line height.
+    page: RGB page image as a numpy array
+    Yields (j, horizontal, image, label) for each usable line"""
+    with open(txt_path, 'r', encoding="utf-8") as f:
+        for j, line in enumerate(f.readlines()):
+            txt = line.split(',')
+            coordinates = [float(i) for i in txt[0:8]]
+            label = txt[-1].strip()
+            if label == '###':
+                continue
+            X = [coordinates[0], coordinates[2], coordinates[4], coordinates[6]]
+            Y = [coordinates[1], coordinates[3], coordinates[5], coordinates[7]]
+            X, Y = clock(np.array([X, Y]))
+            w1 = math.sqrt((X[0] - X[2]) ** 2 + (Y[0] - Y[2]) ** 2)
+            w2 = math.sqrt((X[1] - X[3]) ** 2 + (Y[1] - Y[3]) ** 2)
+            h1 = math.sqrt((X[0] - X[1]) ** 2 + (Y[1] - Y[0]) ** 2)
+            h2 = math.sqrt((X[2] - X[3]) ** 2 + (Y[2] - Y[3]) ** 2)
+            w = max(w1, w2)
+            h = max(h1, h2)
+            horizontal = w > h # 横的图片
+            # Decide the final size before warping, so degenerate quads cost nothing
+            if horizontal:
+                p = int(h) / 31
+                if p < 1:
+                    continue
+                new_height = 31
+                new_width = int(int(w) / p)
+            else: # 竖的图片
+                p = int(w) / 31
+                if p < 1:
+                    continue
+                new_height = int(int(h) / p)
+                new_width = 31
+            # Fold the resize into the homography: one warp, one resampling
+            sx = new_width / int(w)
+            sy = new_height / int(h)
+            Pts1 = np.float32(np.array([[X[0], Y[0]], [X[1], Y[1]], [X[2], Y[2]], [X[3], Y[3]]]))
+            Pts2 = np.float32(np.array([[0, 0], [0, h * sy], [w * sx, h * sy], [w * sx, 0]]))
+            M = cv2.getPerspectiveTransform(Pts1, Pts2)
+            dst = cv2.warpPerspective(page, M, (new_width, new_height))
+            log.debug('%s image: with width %+3s and height %+3s'
+                      % ('horizonal' if horizontal else 'vertical', new_width, new_height))
+            yield j, horizontal, dst, label
+
+def split_name(imgfile):
+    """Return the page name and annotation file name of an image file"""
+    txtname = imgfile.split('.')[0:-1]
+    imgname = '.'.join(txtname)
+    txtname.append('txt')
+    txtname = '.'.join(txtname)
+    return imgname, txtname
+
+def load_page(img_path):
+    """Load a page image once as an RGB numpy array"""
+    return np.asarray(Image.open(img_path).convert('RGB'))
+
+def crop_image(imgfile, text_dir, img_dir, save_dir_hor, save_dir_ver):
+    """Crop every annotated line of one page and save it to the horizontal or
+    vertical output directory.
+    Returns the (name, label) entries of the horizontal and vertical lines"""
+    hor = []
+    ver = []
+    imgname, txtname = split_name(imgfile)
+    page = load_page(os.path.join(img_dir, imgfile))
+    for j, horizontal, dst, label in iter_lines(page, os.path.join(text_dir, txtname)):
+        # name = '/'+str(i)+'_'+str(j)+'.jpg'
+        name = imgname + '_' + str(j) + '.jpg'
+        if horizontal:
+            Image.fromarray(dst).save(os.path.join(save_dir_hor, name))
+            hor.append((name, label))
+        else:
+            Image.fromarray(dst).save(os.path.join(save_dir_ver, name))
+            ver.append((name, label))
+    return hor, ver
+
+def write_labels(f, entries):
+    for name, label in entries:
+        f.write(name + ' ' + label + '\n')
+
+def page_sources(imgfile, text_dir, img_dir):
+    """The source files a page's crops are built from"""
+    imgname, txtname = split_name(imgfile)
+    return [os.path.join(img_dir, imgfile), os.path.join(text_dir, txtname)]
+
+def crop_page(args):
+    """Worker: crop one page.
+    Returns (imgfile, digest, hor, ver); digest is None if the page failed"""
+    imgfile, text_dir, img_dir, save_dir_hor, save_dir_ver = args
+    try:
+        digest = file_digest(page_sources(imgfile, text_dir, img_dir))
+        hor, ver = crop_image(imgfile, text_dir, img_dir, save_dir_hor, save_dir_ver)
+    except Exception as e:
+        log.warning('Error occured during cropping file %s' % (imgfile,))
+        log.error(e)
+        return imgfile, None, [], []
+    return imgfile, digest, hor, ver
+
+def write_label_file(save_dir, manifest, orientation):
+    """Write label.txt of one output directory from the manifest, in page order"""
+    with codecs.open(os.path.join(save_dir, 'label.txt'), 'w', encoding='utf-8') as f:
+        for imgfile in sorted(manifest.keys()):
+            write_labels(f, manifest[imgfile][orientation])
+
+def crop(root_dir='../data/originData', num_workers=1, save_every=100):
+    """Crop all pages of root_dir into the horizontal and vertical output dirs.
+
+    Pages are tracked in a content-hash manifest, so only new or changed pages
+    are cropped again and an interrupted run resumes where it stopped.
+    With num_workers > 1 the pages are cropped by a pool of processes"""
+    text_dir, img_dir, save_dir_hor, save_dir_ver = get_dirs(root_dir)
     if not os.path.exists(save_dir_hor):
         os.mkdir(save_dir_hor)
     if not os.path.exists(save_dir_ver):
         os.mkdir(save_dir_ver)
-    i = 0
-    fh = codecs.open(save_dir_hor + '/label.txt', 'w', encoding='utf-8')
-    fv = codecs.open(save_dir_ver + '/label.txt', 'w', encoding='utf-8')
-    for imgfile in os.listdir(img_dir):
-        i = i + 1
-        img = Image.open(os.path.join(img_dir, imgfile)).convert('RGB')
-        txtname = imgfile.split('.')[0:-1]
-        imgname = '.'.join(txtname)
-        txtname.append('txt')
-        txtname = '.'.join(txtname)
-
-        # For test:
-        if i == 102:
-            break
-
-        with open(os.path.join(text_dir, txtname), 'r', encoding="utf-8") as f:
-            for j, line in enumerate(f.readlines()):
-                txt = line.split(',')
-                coordinates = [float(i) for i in txt[0:8]]
-                label = txt[-1].strip()
-                if label == '###':
-                    continue
-                X = [coordinates[0], coordinates[2], coordinates[4], coordinates[6]]
-                Y = [coordinates[1], coordinates[3], coordinates[5], coordinates[7]]
-                X, Y = clock(np.array([X, Y]))
-                w1 = math.sqrt((X[0] - X[2]) ** 2 + (Y[0] - Y[2]) ** 2)
-                w2 = math.sqrt((X[1] - X[3]) ** 2 + (Y[1] - Y[3]) ** 2)
-                h1 = math.sqrt((X[0] - X[1]) ** 2 + (Y[1] - Y[0]) ** 2)
-                h2 = math.sqrt((X[2] - X[3]) ** 2 + (Y[2] - Y[3]) ** 2)
-                w = max(w1, w2)
-                h = max(h1, h2)
-                Pts1 = np.float32(np.array([[X[0], Y[0]], [X[1], Y[1]], [X[2], Y[2]], [X[3], Y[3]]]))
-                Pts2 = np.float32(np.array([[0, 0], [0, h], [w, h], [w, 0]]))
-                img = np.array(img)
-                M = cv2.getPerspectiveTransform(Pts1, Pts2)
-                dst = cv2.warpPerspective(img, M, (int(w), int(h)))
-                img_new = Image.fromarray(dst)
-                # name = '/'+str(i)+'_'+str(j)+'.jpg'
-                name = imgname + '_' + str(j) + '.jpg'
-                if w > h: # 横的图片
-                    # 对image_new做resize
-                    p = img_new.size[1] / 31
-                    if p < 1:
+    manifest = Manifest(os.path.join(root_dir, 'crop_manifest.json'))
+
+    imgfiles = []
+    for imgfile in sorted(os.listdir(img_dir)):
+        if not os.path.exists(page_sources(imgfile, text_dir, img_dir)[1]):
+            log.warning('Skipping page without annotation: %s' % (imgfile,))
+            continue
+        imgfiles.append(imgfile)
+    # Forget pages that were removed from the source directory
+    for imgfile in set(manifest.keys()) - set(imgfiles):
+        manifest.remove(imgfile)
+
+    todo = [imgfile for imgfile in imgfiles
+            if not manifest.is_current(imgfile, page_sources(imgfile, text_dir, img_dir))]
+    log.info('%s of %s pages are new or changed' % (len(todo), len(imgfiles)))
+    tasks = [(imgfile, text_dir, img_dir, save_dir_hor, save_dir_ver) for imgfile in todo]
+
+    pool = Pool(num_workers) if num_workers > 1 else None
+    pages = pool.imap_unordered(crop_page, tasks, chunksize=4) if pool else map(crop_page, tasks)
+    try:
+        for i, (imgfile, digest, hor, ver) in enumerate(pages):
+            if digest is None:
+                manifest.remove(imgfile)
+                continue
+            outputs = [os.path.join(save_dir_hor, name) for name, _ in hor] + \
+                      [os.path.join(save_dir_ver, name) for name, _ in ver]
+            manifest.update(imgfile, page_sources(imgfile, text_dir, img_dir), outputs,
+                            digest=digest, hor=hor, ver=ver)
+            if (i + 1) % save_every == 0:
+                log.info('%s of %s pages cropped' % (i + 1, len(tasks)))
+                manifest.save()
+    except BaseException:
+        # Keep the pages cropped so far before stopping the workers; on Ctrl-C
+        # they die too and join() would wait for them forever
+        manifest.save()
+        if pool:
+            pool.terminate()
+        raise
+    manifest.save()
+    if pool:
+        pool.close()
+        pool.join()
+
+    write_label_file(save_dir_hor, manifest, 'hor')
+    write_label_file(save_dir_ver, manifest, 'ver')
+
+def encode_page(args):
+    """Worker: crop the horizontal lines of one page and JPEG-encode them in
+    memory as grayscale images.
+    Returns a list of (name, image_data, height, width, label)"""
+    imgfile, text_dir, img_dir = args
+    imgname, txtname = split_name(imgfile)
+    records = []
+    try:
+        page = load_page(os.path.join(img_dir, imgfile))
+        for j, horizontal, dst, label in iter_lines(page, os.path.join(text_dir, txtname)):
+            if not horizontal:
+                continue
+            gray = cv2.cvtColor(dst, cv2.COLOR_RGB2GRAY)
+            ok, image_data = cv2.imencode('.jpg', gray)
+            if not ok:
+                log.warning('Failed to encode line %s of %s' % (j, imgfile))
+                continue
+            records.append((imgname + '_' + str(j) + '.jpg', image_data.tobytes(),
+                            gray.shape[0], gray.shape[1], label))
+    except Exception as e:
+        log.warning('Error occured during cropping file %s' % (imgfile,))
+        log.error(e)
+    return records
+
+def crop_to_tfrecord(output_filebase, root_dir='../data/originData', num_shards=10,
+                     num_workers=1, compression=None):
+    """Stream the cropped horizontal lines of root_dir straight into sharded
+    TFRecord files, without writing intermediate JPEG files.
+    Each line is encoded once; records are dealt round-robin over the shards.
+    compression may be 'GZIP' or 'ZLIB'"""
+    text_dir, img_dir, _, _ = get_dirs(root_dir)
+    imgfiles = sorted(os.listdir(img_dir))
+    tasks = [(imgfile, text_dir, img_dir) for imgfile in imgfiles]
+
+    # Start the workers before tensorflow is imported by the record writer
+    pool = Pool(num_workers) if num_workers > 1 else None
+    tfrecord = importlib.import_module('mjsynth-tfrecord')
+
+    num_digits = len(str(max(num_shards - 1, 1)))
+    shard_format = '%0' + ('%d' % num_digits) + 'd'
+    writers = [tfrecord.ShardWriter(output_filebase + '-' + (shard_format % i) + '.tfrecord', compression)
+               for i in range(num_shards)]
+    pages = pool.imap(encode_page, tasks) if pool else map(encode_page, tasks)
+    count = 0
+    try:
+        try:
+            for i, records in enumerate(pages):
+                # One charset lookup for the labels of all lines of the page
+                page_labels = tfrecord.get_labels_batch([record[4] for record in records])
+                for (name, image_data, height, width, text), labels in zip(records, page_labels):
+                    if labels is None:
+                        log.warning('Skipping line with unknown characters: %s' % (name,))
                         continue
-                    new_height = 31
-                    new_width = int(img_new.size[0] / p)
-                    log.debug('horizonal image: with width %+3s and height %+3s' %(new_width, new_height))
-                    image_resized = img_new.resize((new_width, new_height))
-
-                    image_resized.save(os.path.join(save_dir_hor, name))
-                    fh.write(name + ' ' + label + '\n')
-                else: # 竖的图片
-                    p = img_new.size[0] / 31
-                    if p < 1:
+                    if len(labels) == 0 or not tfrecord.is_writable(width, text):
+                        log.info('Skipping Image with too short width: %s' % (name,))
                         continue
-                    new_height = int(img_new.size[1] / p)
-                    new_width = 31
-                    log.debug('vertical image: with width %+3s and height %+3s' %(new_width, new_height))
-                    image_resized = img_new.resize((new_width, new_height))
-
-                    image_resized.save(os.path.join(save_dir_ver, name))
-                    fv.write(name + ' ' + label + '\n')
-    # break
-    fh.close()
-    fv.close()
+                    example = tfrecord.make_example(name, image_data, labels, text, height, width)
+                    writers[count % num_shards].write(example, width, len(labels))
+                    count += 1
+                log.debug('%s of %s pages, %s records' % (i + 1, len(tasks), count))
+        except BaseException:
+            # On Ctrl-C the workers die too and join() would never return
+            if pool:
+                pool.terminate()
+            raise
+        if pool:
+            pool.close()
+            pool.join()
+    finally:
+        # Close the shards (with their index) however the pool stopped
+        for writer in writers:
+            writer.close()
+    log.info('%s records written to %s shards' % (count, num_shards))
 
 if __name__ == '__main__':
-    crop()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Crop annotated text lines from page images')
+    parser.add_argument('--root_dir', default='../data/originData')
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='Number of crop processes (1 for serial cropping)')
+    parser.add_argument('--tfrecord', default=None,
+                        help='Output file base: write horizontal lines straight to TFRecord shards')
+    parser.add_argument('--num_shards', type=int, default=10)
+    parser.add_argument('--compression', default=None, choices=['GZIP', 'ZLIB'],
+                        help='Compression of the TFRecord shards')
+    args = parser.parse_args()
+    if args.tfrecord:
+        crop_to_tfrecord(args.tfrecord, args.root_dir, args.num_shards, args.num_workers,
+                         args.compression)
+    else:
+        crop(args.root_dir, args.num_workers)
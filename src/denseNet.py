@@ -1,13 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import tensorflow as tf
-from tflearn.layers.conv import global_avg_pool
-from tensorflow.contrib.layers import batch_norm,flatten
-from tensorflow.contrib.layers import xavier_initializer
-from tensorflow.contrib.framework import arg_scope
 from tensorflow.contrib import learn
-import numpy as np
-import os
 
 growth_rate = 32
 filter = 64
@@ -17,7 +11,8 @@ dropout_rate = 0.5
 
 def conv_layer(input,filter,kernel,stride=1,layer_name="conv"):
     with tf.name_scope(layer_name):
-        network = tf.layers.conv2d(inputs=input,use_bias=False,filters=filter,kernel_size=kernel,strides=stride,padding='SAME')
+        network = tf.layers.conv2d(inputs=input,use_bias=False,filters=filter,kernel_size=kernel,strides=stride,padding='SAME',
+                                   name=layer_name)
         return network
 
 def Global_Average_Pooling(x,stride=1):
@@ -28,22 +23,12 @@ def Global_Average_Pooling(x,stride=1):
     return tf.layer.average_pooling2d(inputs=x,pool_size=pool_size,strides=stride)
     # The strdie value does not matter.It is global average pooling without tflearn
     """
-    return global_avg_pool(x,name='Global_avg_pooling')
-    # But maybe you need to install h5py and curses or not
+    return tf.reduce_mean(x,axis=[1,2],name='Global_avg_pooling')
 
 def Batch_Normalization(x,training,scope):
-    with arg_scope([batch_norm],
-                   scope=scope,
-                   update_collections=None,
-                   deacy=0.9,
-                   center=True,
-                   scale=True,
-                   zero_debias_moving_mean=True):
-        if training:
-            return tf.layers.batch_normalization(x,axis=3,training=training,reuse=True)
-
-        else:
-            return tf.layers.batch_normalization(x,axis=3,training=training,reuse=True)
+    # Each batch norm gets its own variables, named after its scope
+    # (reuse=True made every call look for variables that did not exist)
+    return tf.layers.batch_normalization(x,axis=3,training=training,name=scope)
 
 
 # def Batch_Normalization(x, training, scope):
@@ -76,11 +61,28 @@ def Concatenation(layers):
 
 
 
-def bottleneck_layer(x,scope,training):
-    with tf.name_scope(scope):
+def concat_bn_relu_conv(layers,training,scope,efficient=False):
+    """Concatenation, batch norm, relu and 1x1 convolution (to 4*growth_rate
+    maps) of the inputs of a bottleneck.
+    With efficient, only the output of the convolution is kept for backprop:
+    the concatenation and the normalized maps, which grow with the number of
+    layers of a dense block, are recomputed from the (shared) layers"""
+    def fn(*layers):
+        x = Concatenation(list(layers))
         x = Batch_Normalization(x,training=training,scope=scope+'_batch1')
         x = Relu(x)
-        x = conv_layer(x,filter=4*growth_rate,kernel=[1,1],layer_name=scope+'_conv1')
+        return conv_layer(x,filter=4*growth_rate,kernel=[1,1],layer_name=scope+'_conv1')
+    if efficient:
+        # Recomputation reuses the variables of the batch norm and the
+        # convolution by their names; the moving average updates it
+        # recreates are not run
+        fn = tf.contrib.layers.recompute_grad(fn)
+    return fn(*layers)
+
+def bottleneck_layer(layers,scope,training,efficient=False):
+    """layers: the feature maps to concatenate as input"""
+    with tf.name_scope(scope):
+        x = concat_bn_relu_conv(layers,training,scope,efficient)
         x = Drop_out(x,rate=dropout_rate,training=training)
 
         x =Batch_Normalization(x,training=training,scope=scope+'_batch2')
@@ -98,42 +100,50 @@ def transition_layer(x,filters,scope,training):
         x = Average_pooling(x,pool_size=[2,2],stride=[2,1])
         return x
 
-def dense_block(input_x,nb_layers,layer_name,training):
+def dense_block(input_x,nb_layers,layer_name,training,efficient=False):
     with tf.name_scope(layer_name):
         layers_concat =list()
         layers_concat.append(input_x)
 
-        x = bottleneck_layer(input_x,scope=layer_name+'_bottleN_'+str(0),training=training)
-
-        layers_concat.append(x)
-
-        for i in range(nb_layers - 1):
-            x = Concatenation(layers_concat)
-            x = bottleneck_layer(x,scope=layer_name + '_bottleN_' + str(i+1),training=training)
+        for i in range(nb_layers):
+            # The bottleneck concatenates its inputs itself, see concat_bn_relu_conv
+            x = bottleneck_layer(list(layers_concat),scope=layer_name + '_bottleN_' + str(i),
+                                 training=training,efficient=efficient)
             layers_concat.append(x)
 
         x = Concatenation(layers_concat)
 
         return x
 
-def Dense_net(input_x,widths,mode):
+def Dense_net(input_x,widths,mode,efficient=False):
+    """efficient: recompute the concatenations, batch norms and 1x1
+    convolutions of the dense blocks during backprop instead of storing
+    them (same variables)"""
 
     training = (mode == learn.ModeKeys.TRAIN)
+    # recompute_grad needs resource variables
+    with tf.variable_scope('densenet',use_resource=efficient or None):
+        features = Dense_net_layers(input_x,training,efficient)
+        sequence_length = tf.reshape(get_sequence_lengths(widths),[-1], name='seq_len')
+
+    return features,sequence_length
+
+def Dense_net_layers(input_x,training,efficient=False):
     # input_x:[ 32 ,width , 3 ]
     x = conv_layer(input_x,filter=filter,kernel=[3,3],stride=1,layer_name='conv0')
     # x = Max_Pooling(x,pool_size=[3,3],stride=2)
     # x: [32,width,64]
-    x = dense_block(input_x = x,nb_layers=4,layer_name='dense_1',training=training)
+    x = dense_block(input_x = x,nb_layers=4,layer_name='dense_1',training=training,efficient=efficient)
     # x: [32,width,64+4*32=192]
     x = transition_layer(x,128,scope='trans_1',training=training)#transition_layer(x,filters,scope,training)
     # x: [16,width-1,128]
-    x = dense_block(input_x = x,nb_layers=6,layer_name='dense_2',training=training)
+    x = dense_block(input_x = x,nb_layers=6,layer_name='dense_2',training=training,efficient=efficient)
     # x: [16,width,128+6*32=320]
     x = transition_layer(x,256,scope='trans_2',training=training)
     # x: [8,width-1,256]
     x = Max_Pooling(x,[2,2],2)
     # x:[4,width/2,256]
-    x = dense_block(input_x =x ,nb_layers=8,layer_name='dense_3',training=training)
+    x = dense_block(input_x =x ,nb_layers=8,layer_name='dense_3',training=training,efficient=efficient)
     # x: [4,width,256+8*32=512]
     x = transition_layer(x,512,scope='trans_3',training=training)
     # x: [4,width-1,512]
@@ -145,22 +155,21 @@ def Dense_net(input_x,widths,mode):
     # x: [1,width/2,512]
 
     features = tf.squeeze(x,axis=1,name='features')
-    # calculate resulting sequence length
-    one = tf.constant(1, dtype=tf.int32, name='one')
-    two = tf.constant(2, dtype=tf.int32, name='two')
+    return features
 
+def get_sequence_lengths(widths):
+    """Output sequence length of Dense_net for the original image widths,
+    (w-2)//2-2 (works on tensors and numpy arrays)"""
     after_conv0=widths
     after_dense_1=after_conv0
-    after_trans_1=tf.subtract(after_dense_1,one)
+    after_trans_1=after_dense_1-1
     after_dense_2=after_trans_1
-    after_trans_2=tf.subtract(after_dense_2,one)
-    after_first_maxpool=tf.floor_div(after_trans_2, two )#向下取整
+    after_trans_2=after_dense_2-1
+    after_first_maxpool=after_trans_2//2 #向下取整
     after_dense_3=after_first_maxpool
-    after_trans_3=tf.subtract(after_dense_3,one)
-    after_second_maxpool=tf.subtract(after_trans_3,one)
-    sequence_length = tf.reshape(after_second_maxpool,[-1], name='seq_len')
-
-    return features,sequence_length
+    after_trans_3=after_dense_3-1
+    after_second_maxpool=after_trans_3-1
+    return after_second_maxpool
 
 
 
@@ -24,6 +24,8 @@ import tensorflow as tf
 from tensorflow.python.ops import control_flow_ops
 import six
 import model_fn
+import model
+import backbones
 import pipeline
 import filters
 
@@ -59,6 +61,12 @@ tf.app.flags.DEFINE_integer('min_string_length',None,
 tf.app.flags.DEFINE_integer('max_string_length',None,
                             """Maximum allowable input string_length""")
 
+tf.app.flags.DEFINE_enum('backbone','convnet',backbones.names(),
+                         """Convolutional feature extractor""")
+tf.app.flags.DEFINE_enum('seq_head','rnn',model.seq_heads,
+                         """Sequence model: BiLSTM or dilated 1-D convolutions""")
+tf.app.flags.DEFINE_enum('rnn_impl','dynamic',model.rnn_impls,
+                         """LSTM implementation""")
 tf.app.flags.DEFINE_boolean('bucket_data',False,
                             """Bucket training data by width for efficiency""")
 
@@ -78,7 +86,6 @@ def _get_input():
                 data pipelines respectively
     """
 
-    # WARNING: More than two filters causes SEVERE throughput slowdown
     filter_fn = filters.input_filter_fn \
                 ( min_image_width=FLAGS.min_image_width,
                   max_image_width=FLAGS.max_image_width,
@@ -140,7 +147,8 @@ def main(argv=None):
     features, labels = iterator.get_next()
 
     # Construct the evaluation function 
-    evaluate_fn = model_fn.evaluate_fn()
+    evaluate_fn = model_fn.evaluate_fn( FLAGS.rnn_impl, FLAGS.seq_head,
+                                        FLAGS.backbone )
 
     # Wrap the ops in an Estimator spec object
     estimator_spec = evaluate_fn( features, labels, 
@@ -36,13 +36,18 @@
 # mjsynth.py. Filtering is performed after these transformations have
 # been applied. Therefore, filter_fn args will correspond to the
 # return values of `preprocess_fn`.
+#
+# Exception: when the data pipeline provides `parse_fn` and `decode_fn`
+# (as mjsynth.py does), filters are pushed down before the image is
+# decoded, so `image` is still the encoded tf.string. Filters should only
+# look at the record metadata (width, length, text) for this reason.
  
 import tensorflow as tf
 import model
 
 def input_filter_fn( min_image_width=None, max_image_width=None,
                      min_string_length=None, max_string_length=None,
-                     check_input=False):
+                     check_input=False, seq_len_fn=None):
     """Functor for filter based on string or image size
     Input:
       min_image_width  : Python numerical value (or None) representing the 
@@ -55,6 +60,8 @@ def input_filter_fn( min_image_width=None, max_image_width=None,
                          maximum allowable input string length
       check_input: Whether to verify the feature sequence is as long as the 
                     input string
+      seq_len_fn : width->sequence length function of the backbone for 
+                    check_input (model.get_sequence_lengths if None)
    Returns:
       keep_input : Boolean Tensor indicating whether to keep a given input 
                   with the specified image width and string length
@@ -68,13 +75,13 @@ def input_filter_fn( min_image_width=None, max_image_width=None,
                 _get_filter( width, length,
                              min_image_width, max_image_width,
                              min_string_length, max_string_length,
-                             check_input)
+                             check_input, seq_len_fn)
 
     return filter_fn
 
 
 def _get_filter(width, length, min_width, max_width, min_length, max_length,
-                check_input):
+                check_input, seq_len_fn=None):
     """Function for filter based on string or image size
     Input:
       width      : Tensor representing the image width
@@ -89,6 +96,7 @@ def _get_filter(width, length, min_width, max_width, min_length, max_length,
                      maximum allowable input string length
       check_input: Whether to verify the feature sequence is as long as the 
                     input string
+      seq_len_fn : width->sequence length function for check_input
    Returns:
       keep_input : Boolean Tensor indicating whether to keep a given input 
                      with the specified image width and string length
@@ -115,10 +123,11 @@ def _get_filter(width, length, min_width, max_width, min_length, max_length,
         keep_input = add_filter( keep_input,
                                 tf.less_equal(length, max_length) )
     if check_input:
+        seq_len_fn = seq_len_fn or model.get_sequence_lengths
         keep_input = add_filter(
             keep_input,
             tf.less_equal( tf.cast(length,tf.int32),
-                              model.get_sequence_lengths(width) ) )
+                              seq_len_fn(width) ) )
         
     if keep_input!=None:
         keep_input = tf.reshape( keep_input, [] ) # explicitly make a scalar
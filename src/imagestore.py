@@ -0,0 +1,167 @@
+# imagestore.py -- Memory-mapped store of pre-decoded images, an
+#   alternative training source to the JPEG TFRecord files of mjsynth.py.
+#
+# A store directory holds
+#   images.u8 : all images as uint8 grayscale columns, image after image
+#               (each image is stored transposed, [width, height])
+#   index.npz : per image column offset, width, label offsets and text, and
+#               the flat labels of all images
+#
+# Build one from TFRecord files with
+#   python imagestore.py --input_dir ../data/train --output_dir ../data/store
+# and pass it to pipeline.get_data(store_dir=...) (train.py --store_dir).
+# Images are sliced out of the memory map instead of decoding JPEGs.
+
+import argparse
+import io
+import os
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+
+import mjsynth
+
+IMAGES_FILE = 'images.u8'
+INDEX_FILE = 'index.npz'
+
+
+class ImageStore( object ):
+    """Read-only view of a store directory"""
+
+    def __init__( self, store_dir ):
+        index = np.load( os.path.join( store_dir, INDEX_FILE ) )
+        self.height = int( index['height'] )
+        self.offsets = index['offsets']
+        self.widths = index['widths']
+        self.labels = index['labels']
+        self.label_offsets = index['label_offsets']
+        self.texts = index['texts']
+        self.images = np.memmap( os.path.join( store_dir, IMAGES_FILE ),
+                                 dtype=np.uint8, mode='r' ).reshape(
+                                     -1, self.height )
+
+    def __len__( self ):
+        return len( self.widths )
+
+    def get( self, i ):
+        """Image [height, width, 1], width, labels, length and text of image i"""
+        offset = self.offsets[i]
+        width = self.widths[i]
+        # Slicing the memory map is zero-copy; transpose back to [height, width]
+        image = self.images[offset:offset+width].T[:, :, np.newaxis]
+        labels = self.labels[self.label_offsets[i]:self.label_offsets[i+1]]
+        return image, np.int64( width ), labels.astype( np.int64 ), \
+            np.int64( len( labels ) ), self.texts[i].encode( 'utf-8' )
+
+
+def build_store( base_dir, file_patterns, store_dir ):
+    """Decode the images of the matching TFRecord files into a new store"""
+    if not os.path.exists( store_dir ):
+        os.makedirs( store_dir )
+
+    height = None
+    offsets, widths, labels, label_offsets, texts = [], [], [], [0], []
+    offset = 0
+    filenames = mjsynth._get_filenames( base_dir, file_patterns )
+    with open( os.path.join( store_dir, IMAGES_FILE ), 'wb' ) as out:
+        for filename in filenames:
+            options = mjsynth.get_record_options( filename )
+            for record in tf.python_io.tf_record_iterator( filename, options ):
+                example = tf.train.Example.FromString( record )
+                feature = example.features.feature
+                image = Image.open( io.BytesIO(
+                    feature['image/encoded'].bytes_list.value[0] ) )
+                image = np.asarray( image.convert( 'L' ) )
+                if height is None:
+                    height = image.shape[0]
+                elif image.shape[0] != height:
+                    tf.logging.warning( 'Skipping image of height %d in %s' %
+                                        ( image.shape[0], filename ) )
+                    continue
+                out.write( np.ascontiguousarray( image.T ).tobytes() )
+                offsets.append( offset )
+                widths.append( image.shape[1] )
+                offset += image.shape[1]
+                labels.extend( feature['image/labels'].int64_list.value )
+                label_offsets.append( len( labels ) )
+                texts.append( feature['text/string'].bytes_list.value[0]
+                              .decode( 'utf-8' ) )
+            tf.logging.info( '%s: %d images so far' % ( filename, len( widths ) ) )
+
+    np.savez( os.path.join( store_dir, INDEX_FILE ),
+              height=np.int32( height or 0 ),
+              offsets=np.array( offsets, dtype=np.int64 ),
+              widths=np.array( widths, dtype=np.int32 ),
+              labels=np.array( labels, dtype=np.int32 ),
+              label_offsets=np.array( label_offsets, dtype=np.int64 ),
+              texts=np.array( texts, dtype=np.str_ ) )
+    tf.logging.info( 'Stored %d images (%d columns) in %s' %
+                     ( len( widths ), offset, store_dir ) )
+
+
+def get_dataset( args ):
+    """ Get a Dataset from a memory-mapped image store.
+    Parameters:
+      store_dir     : Directory of the store (see build_store)
+      num_threads   : Number of threads to use for reading
+      buffer_sz     : Number of elements to prefetch and buffer
+    Returns:
+      dataset of (image, width, labels, length, text) with
+      image   : raw image, tf.uint8 tensor of shape [height, ?, 1]
+      width   : tf.int64 tensor of shape [1]
+      labels  : tf.int64 tensor of shape [?]
+      length  : tf.int64 tensor of shape [1]
+      text    : tf.string tensor of shape []
+    """
+    [ store_dir, num_threads, buffer_sz ] = args[0:3]
+
+    store = ImageStore( store_dir )
+
+    # Shuffle the whole store: only indices are buffered
+    dataset = tf.data.Dataset.range( len( store ) )
+    dataset = dataset.shuffle( buffer_size=len( store ),
+                               reshuffle_each_iteration=True )
+
+    def read_fn( i ):
+        image, width, labels, length, text = tf.py_func(
+            store.get, [i],
+            [ tf.uint8, tf.int64, tf.int64, tf.int64, tf.string ],
+            stateful=False )
+        image.set_shape( [ store.height, None, 1 ] )
+        width = tf.reshape( width, [1] )
+        labels.set_shape( [ None ] )
+        length = tf.reshape( length, [1] )
+        text.set_shape( [] )
+        return image, width, labels, length, text
+
+    dataset = dataset.map( read_fn, num_parallel_calls=num_threads )
+    return dataset
+
+
+def preprocess_fn( image, width, labels, length, text ):
+    """Prepare the elements of the dataset like mjsynth.preprocess_fn"""
+
+    width = tf.cast( width, tf.int32 ) # for ctc_loss
+
+    label = tf.cast( labels, tf.int32 ) # dense, as in mjsynth.parse_fn
+
+    image = mjsynth.preprocess_image( image )
+
+    return image, width, label, length, text
+
+
+element_length_fn = mjsynth.element_length_fn
+
+postbatch_fn = mjsynth.postbatch_fn
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build a memory-mapped image store from TFRecord files' )
+    parser.add_argument( '--input_dir', default='../data/train/' )
+    parser.add_argument( '--filename_pattern', default='words-*' )
+    parser.add_argument( '--output_dir', default='../data/store/' )
+    args = parser.parse_args()
+    tf.logging.set_verbosity( tf.logging.INFO )
+    build_store( args.input_dir, str.split( args.filename_pattern, ',' ),
+                 args.output_dir )
@@ -21,6 +21,7 @@
 from itertools import chain
 import numpy as np
 import tensorflow as tf
+import charset as default_charset
 
 def read_dict(fname):
     """Read lexicon entries from a file (one per line), adding initial
@@ -35,11 +36,12 @@ def read_dict(fname):
     return vocab 
 
 
-def dictionary_from_file(fname, charset):
+def dictionary_from_file(fname, charset=None):
     """Create a label-indexed version of the lexicon from a lexicon file name.
     Parameters:
       fname   : path to the file name containing the lexicon entries
-      charset : string containing one instance of each valid character
+      charset : sequence containing one instance of each valid character
+                (defaults to the compiled charset, see word_dict.py)
     Returns:
       tensor_dict : A tf.SparseTensor with one row per lexicon entry and 
                     columns containing indices of corresponding chracters
@@ -49,27 +51,31 @@ def dictionary_from_file(fname, charset):
     return dictionary_from_list(vocab, charset)
 
 
-def dictionary_from_list(vocab, charset):
+def dictionary_from_list(vocab, charset=None):
     """Create a label-indexed version of the lexicon from a list of strings.
     Parameters:
       vocab   : list of strings in the lexicon
-      charset : string containing one instance of each valid character
+      charset : sequence containing one instance of each valid character
+                (defaults to the compiled charset, see word_dict.py)
     Returns:
       tensor_dict : A tf.SparseTensor with one row per lexicon entry and 
                     columns containing indices of corresponding chracters
                     in charset.
     """
+    if charset is None:
+        codec = default_charset.codec
+    else:
+        codec = default_charset.LabelCodec(charset)
 
-    # inds are locations of valid character values
-    inds = np.array(
-            [[i, j] for i,word in enumerate(vocab) for j in range(len(word))],
-            dtype=np.int32)
     # parse each character label using charset as index reference
-    vals = np.array(
-            [charset.index(ch) for word in vocab for ch in word], 
-	    dtype=np.int32)
+    vals, offsets = codec.encode_batch(vocab)
+    lengths = np.diff(offsets)
+    # inds are locations of valid character values
+    rows = np.repeat(np.arange(len(vocab)), lengths)
+    cols = np.arange(len(vals)) - np.repeat(offsets[:-1], lengths)
+    inds = np.stack([rows, cols], axis=1).astype(np.int32)
     dims = np.array(
-            [len(vocab), max(map(lambda x: len(x), vocab))], dtype=np.int32)
+            [len(vocab), lengths.max()], dtype=np.int32)
     tensor = tf.SparseTensorValue(indices=inds, values=vals, dense_shape=dims)
     tensor = tf.convert_to_tensor_or_sparse_tensor(tensor)
     return tensor
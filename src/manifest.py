@@ -0,0 +1,102 @@
+# coding:UTF-8
+# manifest.py -- Content-hash manifest for incremental, resumable dataset
+#   builds. Each entry records the sources of one unit of work (a page, a
+#   shard) by content hash together with the files it produced.
+
+import hashlib
+import json
+import os
+from config import log
+
+
+def file_digest(paths, extra=''):
+    """sha1 over the contents of the given files (and an optional string)"""
+    sha = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+    sha.update(extra.encode('utf-8'))
+    return sha.hexdigest()
+
+
+def _text_digest(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def file_stats(paths):
+    """Cheap (size, mtime) signature used to avoid re-hashing untouched files"""
+    stats = []
+    for path in paths:
+        st = os.stat(path)
+        stats.append([st.st_size, st.st_mtime_ns])
+    return stats
+
+
+def stats_signature(paths):
+    """sha1 over the names, sizes and mtimes of files: a cheap signature
+    that changes whenever any of them is touched"""
+    sha = hashlib.sha1()
+    for path, (size, mtime) in zip(paths, file_stats(paths)):
+        sha.update(('%s %s %s\n' % (os.path.basename(path), size, mtime)).encode('utf-8'))
+    return sha.hexdigest()
+
+
+class Manifest(object):
+    """A json file mapping keys to their source digest and output files"""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+            log.info('Loaded manifest %s with %s entries' % (path, len(self.entries)))
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __getitem__(self, key):
+        return self.entries[key]
+
+    def keys(self):
+        return self.entries.keys()
+
+    def is_current(self, key, paths, extra=''):
+        """Whether key was built from the current content of paths and all of
+        its outputs still exist"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return False
+        if not all(os.path.exists(output) for output in entry['outputs']):
+            return False
+        stats = file_stats(paths)
+        if entry['stats'] == stats and entry['extra'] == _text_digest(extra):
+            return True
+        # Touched but maybe not changed: fall back to the content hash
+        if entry['digest'] == file_digest(paths, extra):
+            entry['stats'] = stats
+            entry['extra'] = _text_digest(extra)
+            return True
+        return False
+
+    def update(self, key, paths, outputs, digest=None, extra='', **info):
+        """Record that key was built from paths, producing outputs"""
+        if digest is None:
+            digest = file_digest(paths, extra)
+        entry = {'digest': digest,
+                 'stats': file_stats(paths),
+                 'extra': _text_digest(extra),
+                 'outputs': list(outputs)}
+        entry.update(info)
+        self.entries[key] = entry
+
+    def remove(self, key):
+        self.entries.pop(key, None)
+
+    def save(self):
+        """Write the manifest atomically, so an interrupted run can resume"""
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,338 @@
+# maptextsynth.py -- On-the-fly synthesis of text line images, the dynamic
+#   data source of pipeline.get_data (train.py --nostatic_data).
+#
+# Lines of a corpus are rendered with the fonts of a font directory. With
+# num_producers > 0 the lines are rendered by that many processes, which
+# fill the slots of a ring buffer in shared memory; the training process
+# only copies finished images out of the ring.
+#
+# The synthesizer is configured by a JSON file, e.g.
+#   { "font_dir"    : "../data/fonts",
+#     "corpus_file" : "../data/corpus.txt",
+#     "min_chars"   : 2,
+#     "max_chars"   : 16,
+#     "min_font_size" : 24,
+#     "max_font_size" : 48,
+#     "max_width"   : 512,
+#     "buffer_size" : 256 }
+# and used as
+#   python train.py --nostatic_data --synth_config_file=../data/synth.json
+# Characters of the corpus that are not in the charset are dropped.
+#
+# Preview a few images with
+#   python maptextsynth.py --synth_config_file ../data/synth.json --output_dir /tmp/synth
+
+import argparse
+import atexit
+import json
+import multiprocessing
+import os
+import queue
+import numpy as np
+import tensorflow as tf
+from PIL import Image, ImageDraw, ImageFilter, ImageFont
+
+import charset
+import mjsynth
+
+# Height of the rendered lines, as the crops of crop.py
+IMAGE_HEIGHT = 31
+
+_default_config = {
+    'font_dir'      : '../data/fonts',
+    'corpus_file'   : '../data/corpus.txt',
+    'min_chars'     : 2,
+    'max_chars'     : 16,
+    'min_font_size' : 24,
+    'max_font_size' : 48,
+    'max_width'     : 512,
+    'buffer_size'   : 256,
+    'seed'          : None
+}
+
+# Seconds to wait for a finished image before checking on the producers
+_poll_secs = 10
+
+# Longest text in a ring slot, in bytes of UTF-8 (up to 4 per character)
+_max_text_bytes = lambda config: 4 * config['max_chars']
+
+
+def load_config( config_file ):
+    """Read a synthesizer config file, filling in the defaults"""
+    with open( config_file, 'r', encoding='utf-8' ) as f:
+        config = json.load( f )
+    unknown = set( config ) - set( _default_config )
+    if unknown:
+        raise ValueError( 'Unknown synthesizer options: %s' %
+                          ', '.join( sorted( unknown ) ) )
+    return dict( _default_config, **config )
+
+
+class Synthesizer( object ):
+    """Renders random corpus snippets as grayscale line images"""
+
+    def __init__( self, config, seed=None ):
+        self.config = config
+        self.rng = np.random.RandomState( seed )
+        font_dir = config['font_dir']
+        self.fonts = [ os.path.join( font_dir, name )
+                       for name in sorted( os.listdir( font_dir ) )
+                       if name.lower().endswith( ('.ttf', '.otf', '.ttc') ) ]
+        if not self.fonts:
+            raise IOError( 'No fonts found in %s' % font_dir )
+        self._font_cache = {}
+
+        known = set( charset.out_charset )
+        with open( config['corpus_file'], 'r', encoding='utf-8' ) as f:
+            lines = [ ''.join( c for c in line.strip() if c in known )
+                      for line in f ]
+        self.lines = [ line for line in lines
+                       if len( line ) >= config['min_chars'] ]
+        if not self.lines:
+            raise IOError( 'No usable lines in %s' % config['corpus_file'] )
+
+    def _font( self, index, size ):
+        key = ( index, size )
+        if key not in self._font_cache:
+            self._font_cache[key] = ImageFont.truetype( self.fonts[index], size )
+        return self._font_cache[key]
+
+    def sample_text( self ):
+        """A random snippet of min_chars to max_chars characters"""
+        line = self.lines[ self.rng.randint( len( self.lines ) ) ]
+        length = self.rng.randint( self.config['min_chars'],
+                                   min( self.config['max_chars'],
+                                        len( line ) ) + 1 )
+        start = self.rng.randint( len( line ) - length + 1 )
+        return line[start:start+length]
+
+    def render( self, text ):
+        """Render text as a uint8 image [IMAGE_HEIGHT, width]"""
+        font = self._font( self.rng.randint( len( self.fonts ) ),
+                           self.rng.randint( self.config['min_font_size'],
+                                             self.config['max_font_size'] + 1 ) )
+        left, top, right, bottom = font.getbbox( text )
+        margin = self.rng.randint( 1, 4, size=4 )
+        size = ( right - left + margin[0] + margin[1],
+                 bottom - top + margin[2] + margin[3] )
+
+        # Random contrast between text and background, either polarity
+        background, foreground = sorted( self.rng.randint( 0, 256, size=2 ) )
+        if foreground - background < 64:
+            background, foreground = 32, 224
+        if self.rng.rand() < 0.5:
+            background, foreground = foreground, background
+
+        image = Image.new( 'L', size, int( background ) )
+        ImageDraw.Draw( image ).text( ( margin[0] - left, margin[2] - top ),
+                                      text, fill=int( foreground ), font=font )
+        if self.rng.rand() < 0.3:
+            image = image.filter( ImageFilter.GaussianBlur( self.rng.rand() ) )
+
+        width = max( 1, int( round( size[0] * IMAGE_HEIGHT / float( size[1] ) ) ) )
+        image = np.asarray( image.resize( ( width, IMAGE_HEIGHT ),
+                                          Image.BILINEAR ) )
+        noise = self.rng.normal( 0, 4, size=image.shape )
+        return np.clip( image + noise, 0, 255 ).astype( np.uint8 )
+
+    def sample( self ):
+        """A random (image [IMAGE_HEIGHT, width], text) that fits max_width"""
+        while True:
+            text = self.sample_text()
+            image = self.render( text )
+            if image.shape[1] <= self.config['max_width']:
+                return image, text
+
+    def get( self ):
+        """The next element for the dataset, see get_dataset"""
+        return _get_element( *self.sample() )
+
+
+def _get_element( image, text ):
+    labels = charset.codec.encode( text ).astype( np.int64 )
+    return image[:, :, np.newaxis], np.int64( image.shape[1] ), labels, \
+        np.int64( len( labels ) ), text.encode( 'utf-8' )
+
+
+def _produce( config, seed, ring ):
+    """Producer process: render images into free slots until told to stop"""
+    synth = Synthesizer( config, seed )
+    while True:
+        slot = ring.free.get()
+        if slot is None:
+            break
+        image, text = synth.sample()
+        ring.put( slot, image, text )
+        ring.ready.put( slot )
+
+
+class SynthRing( object ):
+    """Ring of image slots in shared memory, filled by producer processes.
+
+    Slot indices circulate through two queues: producers take a slot from
+    `free`, render into it and hand it over through `ready`; the consumer
+    copies the image out and returns the slot to `free`. Only slot indices
+    go through the queues, never the images."""
+
+    def __init__( self, config, num_producers ):
+        self.config = config
+        buffer_size = config['buffer_size']
+        max_width = config['max_width']
+        # Producers are spawned, not forked, since the parent runs tensorflow
+        context = multiprocessing.get_context( 'spawn' )
+        self.images = context.RawArray( 'B', buffer_size * IMAGE_HEIGHT * max_width )
+        self.widths = context.RawArray( 'i', buffer_size )
+        self.texts = context.RawArray( 'B', buffer_size * _max_text_bytes( config ) )
+        self.text_lengths = context.RawArray( 'i', buffer_size )
+        self.free = context.Queue()
+        self.ready = context.Queue()
+        for slot in range( buffer_size ):
+            self.free.put( slot )
+
+        seed = config['seed']
+        if seed is None:
+            seed = np.random.randint( 2**31 - num_producers )
+        self.producers = [ context.Process( target=_produce,
+                                            args=( config, seed + i, self ) )
+                           for i in range( num_producers ) ]
+        for producer in self.producers:
+            producer.daemon = True
+            producer.start()
+        atexit.register( self.close )
+
+    def __getstate__( self ):
+        # Producers get the shared buffers and queues, not the process list
+        state = self.__dict__.copy()
+        state.pop( 'producers', None )
+        return state
+
+    def _views( self, slot ):
+        """numpy views of the image and text buffers of a slot"""
+        max_width = self.config['max_width']
+        text_bytes = _max_text_bytes( self.config )
+        images = np.frombuffer( self.images, dtype=np.uint8 )
+        texts = np.frombuffer( self.texts, dtype=np.uint8 )
+        image = images[ slot*IMAGE_HEIGHT*max_width :
+                        (slot+1)*IMAGE_HEIGHT*max_width ]
+        text = texts[ slot*text_bytes : (slot+1)*text_bytes ]
+        return image, text
+
+    def put( self, slot, image, text ):
+        """Write an image and its text into a slot"""
+        image_view, text_view = self._views( slot )
+        width = image.shape[1]
+        image_view[:IMAGE_HEIGHT*width] = image.reshape( -1 )
+        data = np.frombuffer( text.encode( 'utf-8' ), dtype=np.uint8 )
+        text_view[:len( data )] = data
+        self.widths[slot] = width
+        self.text_lengths[slot] = len( data )
+
+    def _next_slot( self ):
+        """Wait for a finished slot, raising if the producers have died"""
+        while True:
+            try:
+                return self.ready.get( timeout=_poll_secs )
+            except queue.Empty:
+                pass
+            dead = [ producer for producer in self.producers
+                     if not producer.is_alive() ]
+            if dead:
+                raise RuntimeError( 
+                    '%d of %d synthesizer producers died (exit codes %s); '
+                    'see their error output above' %
+                    ( len( dead ), len( self.producers ),
+                      ', '.join( str( p.exitcode ) for p in dead ) ) )
+
+    def get( self ):
+        """Copy the next finished image out of the ring and release its slot"""
+        slot = self._next_slot()
+        image_view, text_view = self._views( slot )
+        width = self.widths[slot]
+        image = image_view[:IMAGE_HEIGHT*width].reshape( IMAGE_HEIGHT, width ).copy()
+        text = text_view[:self.text_lengths[slot]].tobytes().decode( 'utf-8' )
+        self.free.put( slot )
+        return _get_element( image, text )
+
+    def close( self ):
+        """Stop the producers"""
+        producers = getattr( self, 'producers', [] )
+        for _ in producers:
+            self.free.put( None )
+        for producer in producers:
+            producer.join( timeout=1 )
+            if producer.is_alive():
+                producer.terminate()
+        self.producers = []
+
+
+def get_dataset( args ):
+    """ Get a Dataset of synthesized images.
+    Parameters:
+      synth_config_file : JSON config file of the synthesizer
+      num_producers     : Number of processes rendering images into the
+                          shared-memory ring (0 renders in the input thread)
+    Returns:
+      dataset of (image, width, labels, length, text) with
+      image   : raw image, tf.uint8 tensor of shape [31, ?, 1]
+      width   : tf.int64 tensor of shape [1]
+      labels  : tf.int64 tensor of shape [?]
+      length  : tf.int64 tensor of shape [1]
+      text    : tf.string tensor of shape []
+    """
+    [ synth_config_file, num_producers ] = args[0:2]
+
+    config = load_config( synth_config_file )
+    if num_producers > 0:
+        source = SynthRing( config, num_producers )
+    else:
+        source = Synthesizer( config, config['seed'] )
+
+    def generate():
+        while True:
+            yield source.get()
+
+    dataset = tf.data.Dataset.from_generator(
+        generate,
+        ( tf.uint8, tf.int64, tf.int64, tf.int64, tf.string ),
+        ( tf.TensorShape( [ IMAGE_HEIGHT, None, 1 ] ), tf.TensorShape( [] ),
+          tf.TensorShape( [ None ] ), tf.TensorShape( [] ),
+          tf.TensorShape( [] ) ) )
+    return dataset
+
+
+def preprocess_fn( image, width, labels, length, text ):
+    """Prepare the elements of the dataset like mjsynth.preprocess_fn"""
+
+    width = tf.cast( tf.reshape( width, [1] ), tf.int32 ) # for ctc_loss
+
+    length = tf.reshape( length, [1] )
+
+    label = tf.cast( labels, tf.int32 ) # dense, as in mjsynth.parse_fn
+
+    image = mjsynth.preprocess_image( image )
+
+    return image, width, label, length, text
+
+
+element_length_fn = mjsynth.element_length_fn
+
+postbatch_fn = mjsynth.postbatch_fn
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Write a few synthesized images for inspection' )
+    parser.add_argument( '--synth_config_file', required=True )
+    parser.add_argument( '--output_dir', default='synth_preview' )
+    parser.add_argument( '--num_images', type=int, default=32 )
+    args = parser.parse_args()
+    if not os.path.exists( args.output_dir ):
+        os.makedirs( args.output_dir )
+    synth = Synthesizer( load_config( args.synth_config_file ) )
+    with open( os.path.join( args.output_dir, 'label.txt' ), 'w',
+               encoding='utf-8' ) as f:
+        for i in range( args.num_images ):
+            image, text = synth.sample()
+            name = 'synth_%d.jpg' % i
+            Image.fromarray( image ).save( os.path.join( args.output_dir, name ) )
+            f.write( name + ' ' + text + '\n' )
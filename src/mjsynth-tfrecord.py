@@ -14,11 +14,18 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import argparse
 import os
+import time
 import tensorflow as tf
 import math
-import word_dict
+import struct
+import zlib
+import charset
+import recordindex
 from config import log
+from manifest import Manifest, file_digest
+from multiprocessing import Pool
 
 """Each record within the TFRecord file is a serialized Example proto. 
 The Example proto contains the following fields:
@@ -30,10 +37,10 @@ The Example proto contains the following fields:
   image/text: string specifying the human-readable version of the text
 """
 
-# The list (well, string) of valid output characters
+# The list of valid output characters
 # If any example contains a character not found here, an error will result
-# from the calls to .index in the decoder below
-out_charset=list(word_dict.load_dict())
+# from the label codec in the decoder below
+out_charset=charset.out_charset
 
 jpeg_data = tf.placeholder(dtype=tf.string)
 jpeg_decoder = tf.image.decode_jpeg(jpeg_data,channels=1)
@@ -73,37 +80,137 @@ def calc_seq_len(image_width):
 seq_lens = [calc_seq_len(w) for w in range(1024)]
 
 def gen_data(input_base_dir, image_list_filename, output_filebase, 
-             num_shards=10,start_shard=0):
-    """ Generate several shards worth of TFRecord data """
-    session_config = tf.ConfigProto()
-    session_config.gpu_options.allow_growth=True
-    sess = tf.Session(config=session_config)
+             num_shards=10,start_shard=0,verify=False,num_workers=1,
+             compression=None):
+    """ Generate several shards worth of TFRecord data
+
+    Images are assigned to shards by a hash of their filename, so new or
+    changed images only rebuild the shards they fall into. Finished shards
+    are recorded in a content-hash manifest next to the output, which lets
+    re-runs skip unchanged shards and interrupted runs resume.
+
+    Image sizes are read from the file headers; with verify=True every
+    image is fully decoded instead, to catch corrupt payloads.
+
+    With num_workers > 1 the shards are written by a pool of processes,
+    each with its own reader and writer (and session when verifying).
+    Shards are handed out largest first by input bytes, so the workers
+    finish at about the same time.
+
+    compression may be 'GZIP' or 'ZLIB' to write compressed shards;
+    mjsynth.get_dataset detects and reads them transparently.
+    """
     image_filenames,image_texts = get_image_filenames(os.path.join(input_base_dir,
                                                        image_list_filename))
     num_digits = math.ceil( math.log10( num_shards - 1 ))
     shard_format = '%0'+ ('%d' %num_digits) + 'd' # Use appropriate # leading zeros
-    images_per_shard = int(math.ceil( len(image_filenames) / num_shards ))
-    
+
+    shard_items = [[] for _ in range(num_shards)]
+    for item,filename in enumerate(image_filenames):
+        shard_items[get_shard(filename, num_shards)].append(item)
+
+    manifest = Manifest(output_filebase + '.manifest.json')
+    manifest_args = {}
+
+    tasks = []
     for i in range(start_shard,num_shards):
-        start = i*images_per_shard
-        end   = (i+1)*images_per_shard
+        filenames = [image_filenames[item] for item in shard_items[i]]
+        texts = [image_texts[item] for item in shard_items[i]]
+        sources = [os.path.join(input_base_dir, filename) for filename in filenames]
+        # The labels are part of the shard content too, and their indices
+        # depend on the compiled charset
+        extra = 'charset ' + charset.charset_digest(texts) + '\n' + \
+                '\n'.join(filename + ' ' + text
+                          for filename,text in zip(filenames, texts))
         out_filename = output_filebase+'-'+(shard_format % i)+'.tfrecord'
-        # if os.path.exists(out_filename): # Don't recreate data if restarting
-        #     continue
-        log.info('%s of %s [%s : %s], Output to %s' %(i, num_shards, start, end, out_filename))
-        gen_shard(sess, input_base_dir, image_filenames[start:end], out_filename,image_texts[start:end])
-
-    # Clean up writing last shard
-    start = num_shards * images_per_shard
-    out_filename = output_filebase+'-'+(shard_format % num_shards)+'.tfrecord'
-    log.info('%s of %s [%s :] export to %s' %(i , num_shards, start, out_filename))
-    gen_shard(sess, input_base_dir, image_filenames[start:], out_filename,image_texts[start:])
-
-    sess.close()
-
-def gen_shard(sess, input_base_dir, image_filenames, output_filename, image_texts):
-    """Create a TFRecord file from a list of image filenames"""
-    writer = tf.python_io.TFRecordWriter(output_filename)
+        if manifest.is_current(out_filename, sources, extra): # Don't recreate data if restarting
+            log.info('%s of %s is up to date: %s' %(i, num_shards, out_filename))
+            continue
+        num_bytes = sum(os.path.getsize(source) for source in sources)
+        tasks.append((num_bytes, i, input_base_dir, filenames, texts,
+                      out_filename, verify, compression, extra))
+        manifest_args[out_filename] = (sources, extra)
+
+    # Largest shards first keeps the pool busy until the end
+    tasks.sort(key=lambda task: task[0], reverse=True)
+
+    pool = Pool(num_workers) if num_workers > 1 else None
+    results = pool.imap_unordered(gen_shard_task, tasks) if pool \
+              else map(gen_shard_task, tasks)
+    worker_stats = {}
+    try:
+        for i, out_filename, digest, pid, num_records, num_bytes, seconds in results:
+            log.info('%s of %s [%s records], Output to %s' %(i, num_shards, num_records, out_filename))
+            sources, extra = manifest_args[out_filename]
+            manifest.update(out_filename, sources,
+                            [out_filename, recordindex.index_path(out_filename)],
+                            digest=digest, extra=extra)
+            manifest.save()
+            stats = worker_stats.setdefault(pid, [0, 0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += num_records
+            stats[2] += num_bytes
+            stats[3] += seconds
+    except BaseException:
+        # Finished shards are already in the manifest; on Ctrl-C the workers
+        # die too and join() would wait for them forever
+        if pool:
+            pool.terminate()
+        raise
+    if pool:
+        pool.close()
+        pool.join()
+
+    for pid, (shards, num_records, num_bytes, seconds) in sorted(worker_stats.items()):
+        seconds = max(seconds, 1e-6)
+        log.info('worker %s: %s shards, %s records, %.1f MB in %.1fs '
+                 '(%.1f records/s, %.2f MB/s)'
+                 %(pid, shards, num_records, num_bytes / 2**20, seconds,
+                   num_records / seconds, num_bytes / 2**20 / seconds))
+
+def gen_shard_task(task):
+    """Worker: write one shard and report (shard, output, digest, pid,
+    records, bytes, seconds); digest is the manifest digest of its sources"""
+    global _worker_sess
+    _, i, input_base_dir, filenames, texts, out_filename, verify, compression, extra = task
+    sess = None
+    if verify: # Only a full decode needs a session; one per worker process
+        if _worker_sess is None:
+            session_config = tf.ConfigProto()
+            session_config.gpu_options.allow_growth=True
+            _worker_sess = tf.Session(config=session_config)
+        sess = _worker_sess
+    start = time.time()
+    # Hash the sources here rather than in the parent, and before reading
+    # them, so a change during the run is caught by the next one
+    digest = file_digest([os.path.join(input_base_dir, filename) for filename in filenames],
+                         extra)
+    # Write to a temporary name so an interrupted shard is never taken as done
+    tmp_filename = out_filename + '.tmp'
+    num_records, num_bytes = gen_shard(sess, input_base_dir, filenames, tmp_filename, texts,
+                                       compression,
+                                       recordindex.index_path(out_filename))
+    os.replace(tmp_filename, out_filename)
+    return i, out_filename, digest, os.getpid(), num_records, num_bytes, time.time() - start
+
+_worker_sess = None
+
+def get_shard(filename, num_shards):
+    """Stable shard assignment of an image, independent of the other images"""
+    return zlib.crc32(filename.encode('utf-8')) % num_shards
+
+def gen_shard(sess, input_base_dir, image_filenames, output_filename, image_texts,
+              compression=None, index_filename=None):
+    """Create a TFRecord file from a list of image filenames, plus its
+    sidecar index (see recordindex.py; index_filename defaults to the
+    index name of output_filename)
+    If sess is given, images are verified by decoding them in it
+    Returns the number of records and image bytes written"""
+    writer = ShardWriter(output_filename, compression, index_filename)
+    num_records = 0
+    num_bytes = 0
+    # One charset lookup for the labels of the whole shard
+    shard_labels = get_labels_batch(image_texts)
     
     for item,filename in enumerate(image_filenames):
         path_filename = os.path.join(input_base_dir,filename)
@@ -111,8 +218,11 @@ def gen_shard(sess, input_base_dir, image_filenames, output_filename, image_text
             log.warning('Skipping empty files: %s' %(filename, ))
             continue
         try:
+            text,labels = image_texts[item],shard_labels[item]
+            if labels is None:
+                log.warning('Skipping text with unknown characters: %s' %(filename, ))
+                continue
             image_data,height,width = get_image(sess, path_filename)
-            text,labels = get_text_and_labels(image_texts[item])
             if is_writable(width,text):
                 #查看文本和标签
                 # print(text,labels)
@@ -121,7 +231,9 @@ def gen_shard(sess, input_base_dir, image_filenames, output_filename, image_text
                  else:
                      example = make_example(filename, image_data, labels, text,
                                        height, width)
-                     writer.write(example.SerializeToString())
+                     writer.write(example, width, len(labels))
+                     num_records += 1
+                     num_bytes += len(image_data)
             else:
                 log.info('Skipping Image with too short width: %s' %(filename, ))
         except Exception as e:
@@ -129,6 +241,45 @@ def gen_shard(sess, input_base_dir, image_filenames, output_filename, image_text
             log.warning('Error occured during processing file %s' %(filename, ))
             log.error(e)
     writer.close()
+    return num_records, num_bytes
+
+
+_compression_types = {
+    'GZIP': tf.python_io.TFRecordCompressionType.GZIP,
+    'ZLIB': tf.python_io.TFRecordCompressionType.ZLIB }
+
+def record_writer(filename, compression=None):
+    """Open a TFRecord writer, optionally with 'GZIP' or 'ZLIB' compression"""
+    if not compression:
+        return tf.python_io.TFRecordWriter(filename)
+    options = tf.python_io.TFRecordOptions(_compression_types[compression.upper()])
+    return tf.python_io.TFRecordWriter(filename, options=options)
+
+
+class ShardWriter(object):
+    """TFRecord writer that also records the offset, width and label length
+    of every record, and writes them as the shard's sidecar index on close"""
+
+    def __init__(self, filename, compression=None, index_filename=None):
+        self.writer = record_writer(filename, compression)
+        self.index_filename = index_filename or recordindex.index_path(filename)
+        self.offset = 0
+        self.offsets = []
+        self.widths = []
+        self.lengths = []
+
+    def write(self, example, width, length):
+        data = example.SerializeToString()
+        self.writer.write(data)
+        self.offsets.append(self.offset)
+        self.widths.append(width)
+        self.lengths.append(length)
+        self.offset += len(data) + recordindex.RECORD_OVERHEAD
+
+    def close(self):
+        self.writer.close()
+        recordindex.write_index(self.index_filename, self.offsets,
+                                self.widths, self.lengths)
 
 
 def get_image_filenames(image_list_filename):
@@ -147,17 +298,56 @@ def get_image_filenames(image_list_filename):
     return filenames,texts
 
 def get_image(sess,filename):
-    """Given path to an image file, load its data and size"""
+    """Given path to an image file, load its data and size
+    The size comes from the image header, unless sess is given to run a
+    full (verifying) decode"""
     with tf.gfile.FastGFile(filename, 'rb') as f:
         image_data = f.read()
+    if sess is None:
+        height, width = get_image_size(image_data)
+        return image_data, height, width
     image = sess.run(jpeg_decoder,feed_dict={jpeg_data: image_data})
     height = image.shape[0]
     width = image.shape[1]
     return image_data, height, width
 
+# JPEG start-of-frame markers (all but DHT, JPG and DAC) carry the image size
+_sof_markers = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+def get_image_size(image_data):
+    """Read (height, width) from the JPEG or PNG header without decoding"""
+    if image_data[:8] == b'\x89PNG\r\n\x1a\n':
+        width, height = struct.unpack('>II', image_data[16:24])
+        return height, width
+    if image_data[:2] != b'\xff\xd8':
+        raise ValueError('Not a JPEG or PNG image')
+    pos = 2
+    while pos + 4 <= len(image_data):
+        if image_data[pos] != 0xFF:
+            raise ValueError('Corrupt JPEG marker at byte %d' % pos)
+        marker = image_data[pos+1]
+        if marker == 0xFF: # Fill byte
+            pos += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7: # No payload
+            pos += 2
+            continue
+        if marker == 0xDA: # Start of scan before any frame header
+            break
+        if marker in _sof_markers:
+            height, width = struct.unpack('>HH', image_data[pos+5:pos+9])
+            return height, width
+        segment_length, = struct.unpack('>H', image_data[pos+2:pos+4])
+        pos += 2 + segment_length
+    raise ValueError('No JPEG frame header found')
+
 def is_writable(image_width,text):
     """Determine whether the CNN-processed image is longer than the string"""
-    return (image_width > min_width) and (len(text) <= seq_lens[image_width]) #使用查表法而非对每个输入进行计算, 提高运行速度.
+    if image_width < len(seq_lens):
+        seq_len = seq_lens[image_width] #使用查表法而非对每个输入进行计算, 提高运行速度.
+    else: # Lines wider than the table (long MTWI lines)
+        seq_len = calc_seq_len(image_width)
+    return (image_width > min_width) and (len(text) <= seq_len)
     
 def get_text_and_labels(text):
     """ Extract the human-readable text and label sequence from image filename"""
@@ -166,9 +356,26 @@ def get_text_and_labels(text):
     # text = os.path.basename(filename).split('_',2)[1]
     # Transform string text to sequence of indices using charset, e.g.,
     # MONIKER -> [12, 14, 13, 8, 10, 4, 17]
-    labels = [out_charset.index(c) for c in list(text)]
+    labels = charset.codec.encode(text).tolist()
     return text,labels
 
+def get_labels_batch(texts):
+    """Label sequences of many texts with a single charset lookup.
+    Texts with characters outside the charset get None"""
+    try:
+        labels, offsets = charset.codec.encode_batch(texts)
+    except ValueError:
+        # Rare: look for the offending texts one by one
+        return [_get_labels_or_none(text) for text in texts]
+    labels = labels.tolist()
+    return [labels[offsets[i]:offsets[i+1]] for i in range(len(texts))]
+
+def _get_labels_or_none(text):
+    try:
+        return charset.codec.encode(text).tolist()
+    except ValueError:
+        return None
+
 def make_example(filename, image_data, labels, text, height, width):
     """Build an Example proto for an example.
     Args:
@@ -199,7 +406,22 @@ def _bytes_feature(values):
     return tf.train.Feature(bytes_list=tf.train.BytesList(value=[values]))
 
 def main(argv=None):
-    gen_data('../data/originData/crop_img_hor', 'label.txt', '../data/train/words')
+    parser = argparse.ArgumentParser(description='Write labelled images to sharded TFRecord files')
+    parser.add_argument('--input_base_dir', default='../data/originData/crop_img_hor')
+    parser.add_argument('--image_list', default='label.txt',
+                        help='Label file in input_base_dir, one "filename text" per line')
+    parser.add_argument('--output_filebase', default='../data/train/words')
+    parser.add_argument('--num_shards', type=int, default=10)
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='Number of shard writing processes (1 for serial writing)')
+    parser.add_argument('--verify', action='store_true',
+                        help='Fully decode every image to catch corrupt payloads')
+    parser.add_argument('--compression', default=None, choices=['GZIP', 'ZLIB'],
+                        help='Compression of the TFRecord shards')
+    args = parser.parse_args(argv)
+    gen_data(args.input_base_dir, args.image_list, args.output_filebase,
+             num_shards=args.num_shards, verify=args.verify,
+             num_workers=args.num_workers, compression=args.compression)
     # gen_data('../data/images', 'annotation_val.txt',   '../data/val/words')
     # gen_data('../data/images', 'annotation_test.txt',  '../data/test/words')
 
@@ -18,9 +18,26 @@
 #   as Examples in in TFRecord files.
 
 import os
+import struct
 import tensorflow as tf
 import numpy as np
 import pipeline
+import recordindex
+
+_feature_map = {
+    'image/encoded'  :   tf.FixedLenFeature( [], dtype=tf.string, 
+                                             default_value='' ),
+    'image/labels'   :   tf.VarLenFeature( dtype=tf.int64 ), 
+    'image/width'    :   tf.FixedLenFeature( [1], dtype=tf.int64,
+                                             default_value=1 ),
+    'image/filename' :   tf.FixedLenFeature( [], dtype=tf.string,
+                                             default_value='' ),
+    'text/string'    :   tf.FixedLenFeature( [], dtype=tf.string,
+                                             default_value='' ),
+    'text/length'    :   tf.FixedLenFeature( [1], dtype=tf.int64,
+                                             default_value=1 )
+}
+
 
 def get_dataset( args ):
     """ Get a Dataset from TFRecord files.
@@ -29,6 +46,11 @@ def get_dataset( args ):
       file_patterns : List of wildcard patterns for TFRecord files to read
       num_threads   : Number of threads to use for reading and processing
       buffer_sz     : Number of Examples to prefetch and buffer
+      seed          : (optional) Seed of the filename shuffle, so that the
+                      input order can be restored from a checkpoint
+      shuffle_records : (optional) Whether to read the records of all files
+                      in a globally random order by positioned reads, via
+                      the shard indexes (uncompressed shards only)
     Returns:
       image   : preprocessed image
                   tf.float32 tensor of shape [32, ?, 1] (? = width)
@@ -44,52 +66,106 @@ def get_dataset( args ):
 
     # Extract args
     [ base_dir, file_patterns, num_threads, buffer_sz ] = args[0:4]
+    seed = args[4] if len( args ) > 4 else None
+    shuffle_records = args[5] if len( args ) > 5 else False
 
     # Get filenames as list of tensors
     tensor_filenames = _get_filenames( base_dir, file_patterns )
 
-    # Get filenames into a dataset format
-    ds_filenames = tf.data.Dataset.from_tensor_slices( tensor_filenames )
+    if shuffle_records:
+        return _get_shuffled_records( tensor_filenames, num_threads, seed )
+
+    # Compressed shards are detected per file
+    compression_types = [get_compression_type( filename )
+                         for filename in tensor_filenames]
+
+    if len( set( compression_types ) ) <= 1:
+        compression_type = compression_types[0] if compression_types else ''
+
+        # Get filenames into a dataset format
+        ds_filenames = tf.data.Dataset.from_tensor_slices( tensor_filenames )
 
-    # Shuffle for some stochasticity
-    ds_filenames = ds_filenames.shuffle( buffer_size=len( tensor_filenames ),
-                                         reshuffle_each_iteration=True )
+        # Shuffle for some stochasticity
+        ds_filenames = ds_filenames.shuffle( buffer_size=len( tensor_filenames ),
+                                             seed=seed,
+                                             reshuffle_each_iteration=True )
     
-    dataset = tf.data.TFRecordDataset( ds_filenames, 
-                                       num_parallel_reads=num_threads,
-                                       buffer_size=buffer_sz )
+        dataset = tf.data.TFRecordDataset( ds_filenames, 
+                                           compression_type=compression_type,
+                                           num_parallel_reads=num_threads,
+                                           buffer_size=buffer_sz )
+    else:
+        # Mixed compression: read each file with its own compression type
+        ds_filenames = tf.data.Dataset.from_tensor_slices(
+            ( tensor_filenames, compression_types ) )
+        ds_filenames = ds_filenames.shuffle( buffer_size=len( tensor_filenames ),
+                                             seed=seed,
+                                             reshuffle_each_iteration=True )
+        dataset = ds_filenames.apply( tf.contrib.data.parallel_interleave(
+            lambda filename, compression_type: tf.data.TFRecordDataset(
+                filename, compression_type=compression_type, 
+                buffer_size=buffer_sz ),
+            cycle_length=num_threads ) )
+    return dataset
+
+
+def _get_shuffled_records( filenames, num_threads, seed=None ):
+    """Dataset of the serialized records of all files in a random order.
+    Only record numbers are shuffled (8 bytes each, whatever the record
+    size); each record is then read at its indexed offset"""
+    for filename in filenames:
+        if get_compression_type( filename ) != '':
+            raise ValueError( 'Record shuffling needs uncompressed shards: %s'
+                              % filename )
+        if not os.path.exists( recordindex.index_path( filename ) ):
+            raise IOError( 'Record shuffling needs shard indexes: %s'
+                           % recordindex.index_path( filename ) )
+
+    reader = recordindex.RecordReader( filenames )
+
+    dataset = tf.data.Dataset.range( len( reader ) )
+    dataset = dataset.shuffle( buffer_size=len( reader ), seed=seed,
+                               reshuffle_each_iteration=True )
+
+    def read_fn( i ):
+        data = tf.py_func( reader.read, [i], tf.string, stateful=False )
+        data.set_shape( [] )
+        return data
+
+    dataset = dataset.map( read_fn, num_parallel_calls=num_threads )
     return dataset
 
 
 def preprocess_fn( data ):
     """Parse the elements of the dataset"""
+    return decode_fn( *parse_fn( data ) )
 
-    feature_map = {
-        'image/encoded'  :   tf.FixedLenFeature( [], dtype=tf.string, 
-                                                 default_value='' ),
-        'image/labels'   :   tf.VarLenFeature( dtype=tf.int64 ), 
-        'image/width'    :   tf.FixedLenFeature( [1], dtype=tf.int64,
-                                                 default_value=1 ),
-        'image/filename' :   tf.FixedLenFeature( [], dtype=tf.string,
-                                                 default_value='' ),
-        'text/string'    :   tf.FixedLenFeature( [], dtype=tf.string,
-                                                 default_value='' ),
-        'text/length'    :   tf.FixedLenFeature( [1], dtype=tf.int64,
-                                                 default_value=1 )
-    }
-    
-    features = tf.parse_single_example( data, feature_map )
+
+def parse_fn( data ):
+    """Parse the record fields, leaving the image encoded (so that filters
+    on the record metadata can run before the decode)"""
+
+    features = tf.parse_single_example( data, _feature_map )
     
     # Initialize fields according to feature map
 
-    # Convert to grayscale
-    image = tf.image.decode_jpeg( features['image/encoded'], channels=1 ) 
-
+    image = features['image/encoded']
     width = tf.cast( features['image/width'], tf.int32 ) # for ctc_loss
-    label = tf.serialize_sparse( features['image/labels'] ) # for batching
+    # Dense labels batch with padding; length says which entries are real
+    label = tf.cast( tf.sparse_tensor_to_dense( features['image/labels'] ),
+                     tf.int32 )
     length = features['text/length']
     text = features['text/string']
 
+    return image, width, label, length, text
+
+
+def decode_fn( image, width, label, length, text ):
+    """Decode and preprocess the image of a parsed record"""
+
+    # Convert to grayscale
+    image = tf.image.decode_jpeg( image, channels=1 ) 
+
     image = preprocess_image( image )
 
     return image, width, label, length, text
@@ -103,9 +179,8 @@ def postbatch_fn( image, width, label, length, text ):
     """Post-batching, postprocessing: packs raw tensors into a dictionary for 
        Dataset's iterator output"""
 
-    # Batching is complete, so now we can re-sparsify our labels for ctc_loss
-    label = tf.cast( tf.deserialize_many_sparse( label, tf.int64 ),
-                     tf.int32 )
+    # Batching is complete, so now we can sparsify our labels for ctc_loss
+    label = dense_to_sparse_labels( label, length )
     
     # Format relevant features for estimator ingestion
     features = {
@@ -118,18 +193,85 @@ def postbatch_fn( image, width, label, length, text ):
     return features, label
 
 
+def dense_to_sparse_labels( label, length ):
+    """Build the SparseTensor of a batch of padded dense labels
+    Parameters:
+      label  : tf.int32 tensor of shape [batch, ?], padded labels
+      length : tensor of shape [batch] or [batch, 1], label lengths
+    Returns:
+      tf.SparseTensor of the first length[i] labels of each row
+    """
+    length = tf.reshape( tf.cast( length, tf.int32 ), [-1] )
+    mask = tf.sequence_mask( length, tf.shape( label )[1] )
+    indices = tf.where( mask )
+    values = tf.gather_nd( label, indices )
+    dense_shape = tf.cast( tf.shape( label ), tf.int64 )
+    return tf.SparseTensor( indices, values, dense_shape )
+
+
 def _get_filenames( base_dir, file_patterns=['*.tfrecord'] ):
     """Get a list of record files"""
     
-    # List of lists ...
-    data_files = [tf.gfile.Glob( os.path.join( base_dir, file_pattern ) )
+    # List of lists (sorted, so a seeded shuffle gives the same order) ...
+    data_files = [sorted( tf.gfile.Glob( os.path.join( base_dir, file_pattern ) ) )
                   for file_pattern in file_patterns]
-    # flatten
-    data_files = [data_file for sublist in data_files for data_file in sublist]
+    # flatten, leaving out sidecar indexes and unfinished shards
+    data_files = [data_file for sublist in data_files for data_file in sublist
+                  if not recordindex.is_index( data_file )
+                  and not data_file.endswith( '.tmp' )]
 
     return data_files
 
 
+def get_compression_type( filename ):
+    """Detect whether a TFRecord file is uncompressed (''), 'GZIP' or 'ZLIB'
+    An uncompressed file starts with a record length and its masked crc32c"""
+    with open( filename, 'rb' ) as f:
+        header = f.read( 12 )
+    if len( header ) == 0:
+        return ''
+    if len( header ) == 12 and \
+       struct.unpack( '<I', header[8:] )[0] == _masked_crc32c( header[:8] ):
+        return ''
+    if header[:2] == b'\x1f\x8b':
+        return 'GZIP'
+    if len( header ) >= 2 and header[0] & 0x0f == 8 and \
+       ( header[0] * 256 + header[1] ) % 31 == 0:
+        return 'ZLIB'
+    raise ValueError( 'Unrecognized TFRecord file: %s' % filename )
+
+
+def get_record_options( filename ):
+    """TFRecordOptions for reading a file with tf.python_io.tf_record_iterator"""
+    compression_types = {
+        ''     : tf.python_io.TFRecordCompressionType.NONE,
+        'GZIP' : tf.python_io.TFRecordCompressionType.GZIP,
+        'ZLIB' : tf.python_io.TFRecordCompressionType.ZLIB }
+    return tf.python_io.TFRecordOptions(
+        compression_types[get_compression_type( filename )] )
+
+
+def _make_crc32c_table():
+    table = []
+    for n in range( 256 ):
+        crc = n
+        for _ in range( 8 ):
+            crc = ( crc >> 1 ) ^ 0x82F63B78 if crc & 1 else crc >> 1
+        table.append( crc )
+    return table
+
+_crc32c_table = _make_crc32c_table()
+
+
+def _masked_crc32c( data ):
+    """The masked crc32c TFRecord files use to check record lengths"""
+    crc = 0xFFFFFFFF
+    for byte in bytearray( data ):
+        crc = _crc32c_table[( crc ^ byte ) & 0xFF] ^ ( crc >> 8 )
+    crc ^= 0xFFFFFFFF
+    return ( ( ( crc >> 15 ) | ( crc << 17 ) ) + 0xa282ead8 ) & 0xFFFFFFFF
+
+
 def preprocess_image( image ):
     """Preprocess image: Rescale and fix image height"""
 
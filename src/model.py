@@ -16,8 +16,8 @@
 
 # model.py -- Constructs the graph representing the network
 #   model. Inputs start from convnet_layers(), whose outputs hook into
-#   rnn_layers(), which produces the logits for CTC loss (for
-#   training) and decoding (for prediction/evaluation).
+#   rnn_layers() (or seqconv_layers()), which produces the logits for CTC
+#   loss (for training) and decoding (for prediction/evaluation).
 
 import tensorflow as tf
 from tensorflow.contrib import learn
@@ -33,6 +33,14 @@ layer_params = [ [  64, 3, 'valid', 'conv1', False],
                  [ 512, 3, 'same',  'conv8', True] ] # hpool 3
 
 rnn_size = 2**9    # Dimensionality of all RNN elements' hidden layers
+rnn_impls = ['dynamic', 'fused'] # See rnn_layer
+
+seq_heads = ['rnn', 'seqconv'] # Sequence models on top of the convnet
+
+# Dilation rates of the residual conv1d layers of seqconv_layers (the
+# receptive field is 1+2*sum(rates) = 33 timesteps)
+seqconv_dilations = [1, 2, 4, 8, 1]
+seqconv_size = 2**9 # Filters of all seqconv layers
 dropout_rate = 0.5 # For RNN layers (currently not used--uncomment below)
 
 def conv_layer( bottom, params, training ):
@@ -63,6 +71,36 @@ def conv_layer( bottom, params, training ):
     return top
 
 
+def sepconv_layer( bottom, params, training ):
+    """Build a depthwise-separable convolutional layer using entry from 
+    layer_params"""
+
+    batch_norm = params[4] # Boolean
+
+    if batch_norm:
+        activation = None
+    else:
+        activation = tf.nn.relu
+
+    kernel_initializer = tf.contrib.layers.variance_scaling_initializer()
+    bias_initializer = tf.constant_initializer( value=0.0 )
+
+    top = tf.layers.separable_conv2d( bottom, 
+                                      filters=params[0],
+                                      kernel_size=params[1],
+                                      padding=params[2],
+                                      activation=activation,
+                                      depthwise_initializer=kernel_initializer,
+                                      pointwise_initializer=kernel_initializer,
+                                      bias_initializer=bias_initializer,
+                                      name=params[3] )
+    if batch_norm:
+        top = norm_layer( top, training, params[3]+'/batch_norm' )
+        top = tf.nn.relu( top, name=params[3]+'/relu' )
+
+    return top
+
+
 def pool_layer( bottom, wpool, padding, name ):
     """Short function to build a pooling layer with less syntax"""
     top = tf.layers.max_pooling2d( bottom, 
@@ -119,6 +157,44 @@ def convnet_layers( inputs, widths, mode ):
         return features, sequence_length
 
 
+def sepconv_layers( inputs, widths, mode ):
+    """
+    Build the convnet_layers architecture from depthwise-separable
+    convolutions (except conv1, whose input has a single channel), with the
+    same pooling and thus the same get_sequence_lengths
+    """
+
+    training = (mode == learn.ModeKeys.TRAIN)
+
+    # inputs should have shape [ ?, 32, ?, 1 ]
+    with tf.variable_scope( "sepconv" ): # h,w
+        
+        conv1 = conv_layer( inputs, layer_params[0], training )    # 30,30
+        conv2 = sepconv_layer( conv1, layer_params[1], training )  # 30,30
+        pool2 = pool_layer( conv2, 2, 'valid', 'pool2' )           # 15,15
+        conv3 = sepconv_layer( pool2, layer_params[2], training )  # 15,15
+        conv4 = sepconv_layer( conv3, layer_params[3], training )  # 15,15
+        pool4 = pool_layer( conv4, 1, 'valid', 'pool4' )           # 7,14
+        conv5 = sepconv_layer( pool4, layer_params[4], training )  # 7,14
+        conv6 = sepconv_layer( conv5, layer_params[5], training )  # 7,14
+        pool6 = pool_layer( conv6, 1, 'valid', 'pool6')            # 3,13
+        conv7 = sepconv_layer( pool6, layer_params[6], training )  # 3,13
+        conv8 = sepconv_layer( conv7, layer_params[7], training )  # 3,13
+        pool8 = tf.layers.max_pooling2d( conv8, [3, 1], [3, 1], 
+                                         padding='valid', 
+                                         name='pool8' )            # 1,13
+
+        # squeeze row dim
+        features = tf.squeeze( pool8, axis=1, name='features' ) 
+        
+        sequence_length = get_sequence_lengths( widths )
+        
+        # Vectorize
+        sequence_length = tf.reshape( sequence_length, [-1], name='seq_len' ) 
+
+        return features, sequence_length
+
+
 def get_sequence_lengths( widths ):    
     """Tensor calculating output sequence length from original image widths"""
     kernel_sizes = [params[1] for params in layer_params]
@@ -137,8 +213,20 @@ def get_sequence_lengths( widths ):
     return after_pool8
 
 
-def rnn_layer( bottom_sequence, sequence_length, rnn_size, scope ):
-    """Build bidirectional (concatenated output) RNN layer"""
+def rnn_layer( bottom_sequence, sequence_length, rnn_size, scope,
+               rnn_impl='dynamic' ):
+    """Build bidirectional (concatenated output) RNN layer
+    rnn_impl: 'dynamic' runs CudnnCompatibleLSTMCell one step at a time in
+              bidirectional_dynamic_rnn; 'fused' runs the whole sequence in
+              one LSTMBlockFusedCell kernel (much faster on CPU). Both
+              create the same variables, so checkpoints are interchangeable
+    """
+
+    if rnn_impl == 'fused':
+        return fused_rnn_layer( bottom_sequence, sequence_length, rnn_size, 
+                                scope )
+    elif rnn_impl != 'dynamic':
+        raise ValueError( 'Unknown rnn_impl: %s' % rnn_impl )
 
     weight_initializer = tf.truncated_normal_initializer( stddev=0.01 )
 
@@ -174,7 +262,37 @@ def rnn_layer( bottom_sequence, sequence_length, rnn_size, scope ):
     return rnn_output_stack
 
 
-def rnn_layers( features, sequence_length, num_classes ):
+def fused_rnn_layer( bottom_sequence, sequence_length, rnn_size, scope ):
+    """Build bidirectional (concatenated output) RNN layer from fused LSTM 
+    kernels, with the variable names of rnn_layer's CudnnCompatibleLSTMCell"""
+
+    with tf.variable_scope( scope ):
+        # Same gate layout and forget bias as CudnnCompatibleLSTMCell
+        cell_fw = tf.contrib.rnn.LSTMBlockFusedCell( 
+            rnn_size, forget_bias=0.0, name='cudnn_compatible_lstm_cell' )
+        cell_bw = tf.contrib.rnn.TimeReversedFusedRNN( 
+            tf.contrib.rnn.LSTMBlockFusedCell( 
+                rnn_size, forget_bias=0.0, 
+                name='cudnn_compatible_lstm_cell' ) )
+
+        # Outputs beyond sequence_length are zero, as in dynamic_rnn
+        with tf.variable_scope( 'fw' ):
+            output_fw,_ = cell_fw( bottom_sequence, 
+                                   sequence_length=sequence_length,
+                                   dtype=tf.float32 )
+        with tf.variable_scope( 'bw' ):
+            output_bw,_ = cell_bw( bottom_sequence, 
+                                   sequence_length=sequence_length,
+                                   dtype=tf.float32 )
+
+    # [ paddedSeqLen batchSize 2*rnn_size]
+    rnn_output_stack = tf.concat( [output_fw, output_bw], 2, 
+                                  name='output_stack' )
+    
+    return rnn_output_stack
+
+
+def rnn_layers( features, sequence_length, num_classes, rnn_impl='dynamic' ):
     """Build a stack of RNN layers from input features"""
 
     # Input features is [batchSize paddedSeqLen numFeatures]
@@ -187,8 +305,10 @@ def rnn_layers( features, sequence_length, num_classes ):
         rnn_sequence = tf.transpose( features, 
                                      perm=[1, 0, 2], 
                                      name='time_major' )
-        rnn1 = rnn_layer( rnn_sequence, sequence_length, rnn_size, 'bdrnn1' )
-        rnn2 = rnn_layer( rnn1, sequence_length, rnn_size, 'bdrnn2' )
+        rnn1 = rnn_layer( rnn_sequence, sequence_length, rnn_size, 'bdrnn1',
+                          rnn_impl )
+        rnn2 = rnn_layer( rnn1, sequence_length, rnn_size, 'bdrnn2',
+                          rnn_impl )
         rnn_logits = tf.layers.dense( rnn2, 
                                       num_classes+1, 
                                       activation=logit_activation,
@@ -198,6 +318,53 @@ def rnn_layers( features, sequence_length, num_classes ):
         return rnn_logits
     
 
+def seqconv_layers( features, sequence_length, num_classes ):
+    """Build a stack of dilated 1-D convolutions from input features, an 
+    alternative to rnn_layers that computes all timesteps in parallel"""
+
+    # Input features is [batchSize paddedSeqLen numFeatures]
+    logit_activation = tf.nn.relu
+    weight_initializer = tf.contrib.layers.variance_scaling_initializer()
+    bias_initializer = tf.constant_initializer( value=0.0 )
+
+    with tf.variable_scope( "seqconv" ):
+        # Zero the padding beyond each sequence after every layer, so that
+        # it does not leak into the valid timesteps 
+        mask = tf.sequence_mask( sequence_length, tf.shape( features )[1],
+                                 dtype=tf.float32 )
+        mask = tf.expand_dims( mask, 2, name='mask' )
+
+        sequence = features
+        if features.shape[2].value != seqconv_size:
+            sequence = tf.layers.dense( sequence, seqconv_size,
+                                        kernel_initializer=weight_initializer,
+                                        bias_initializer=bias_initializer,
+                                        name='project' )
+        sequence = sequence * mask
+
+        for i, rate in enumerate( seqconv_dilations ):
+            conv = tf.layers.conv1d( sequence,
+                                     filters=seqconv_size,
+                                     kernel_size=3,
+                                     padding='same',
+                                     dilation_rate=rate,
+                                     activation=tf.nn.relu,
+                                     kernel_initializer=weight_initializer,
+                                     bias_initializer=bias_initializer,
+                                     name='conv%d' % (i+1) )
+            sequence = ( sequence + conv ) * mask # residual
+
+        logits = tf.layers.dense( sequence, 
+                                  num_classes+1, 
+                                  activation=logit_activation,
+                                  kernel_initializer=weight_initializer,
+                                  bias_initializer=bias_initializer,
+                                  name='logits' )
+        # Time-major, as the rnn_layers logits expected by ctc_loss_layer
+        logits = tf.transpose( logits, perm=[1, 0, 2], name='time_major' )
+        return logits
+
+
 def ctc_loss_layer( rnn_logits, sequence_labels, sequence_length ):
     """Build CTC Loss layer for training"""
     loss = tf.nn.ctc_loss( sequence_labels, 
@@ -19,6 +19,7 @@
 
 import tensorflow as tf
 import model
+import backbones
 import mjsynth
 import charset
 import pipeline
@@ -26,18 +27,24 @@ import pipeline
 from lexicon import dictionary_from_file
 
 
-def _get_image_info(features, mode):
+def _get_image_info(features, mode, rnn_impl='dynamic', seq_head='rnn',
+                    backbone='convnet'):
     """Calculates the logits and sequence length"""
 
     image = features['image']
     width = features['width']
 
-    conv_features, sequence_length = model.convnet_layers(image,
-                                                          width,
-                                                          mode)
+    layers_fn = backbones.get_backbone(backbone).layers_fn
+    conv_features, sequence_length = layers_fn(image, width, mode)
 
-    logits = model.rnn_layers(conv_features, sequence_length,
-                              charset.num_classes())
+    if seq_head == 'seqconv':
+        logits = model.seqconv_layers(conv_features, sequence_length,
+                                      charset.num_classes())
+    elif seq_head == 'rnn':
+        logits = model.rnn_layers(conv_features, sequence_length,
+                                  charset.num_classes(), rnn_impl)
+    else:
+        raise ValueError('Unknown seq_head: %s' % seq_head)
 
     return logits, sequence_length
 
@@ -62,7 +69,7 @@ def _get_init_pretrained(tune_from):
 
 def _get_training(rnn_logits, label, sequence_length, tune_scope,
                   learning_rate, decay_steps, decay_rate, decay_staircase,
-                  momentum):
+                  momentum, backbone='convnet'):
     """Set up training ops"""
 
     with tf.name_scope("train"):
@@ -70,7 +77,7 @@ def _get_training(rnn_logits, label, sequence_length, tune_scope,
         if tune_scope:
             scope = tune_scope
         else:
-            scope = "convnet|rnn"
+            scope = backbones.get_backbone(backbone).scope + "|rnn|seqconv"
 
         rnn_vars = tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES,
                                      scope=scope)
@@ -247,17 +254,20 @@ def _get_output(rnn_logits, sequence_length, lexicon):
 
 
 def train_fn(scope, tune_from, learning_rate,
-             decay_steps, decay_rate, decay_staircase, momentum):
+             decay_steps, decay_rate, decay_staircase, momentum,
+             rnn_impl='dynamic', seq_head='rnn', backbone='convnet'):
     """Returns a function that trains the model"""
 
     def train(features, labels, mode):
-        logits, sequence_length = _get_image_info(features, mode)
+        logits, sequence_length = _get_image_info(features, mode, rnn_impl,
+                                                  seq_head, backbone)
 
         train_op, loss = _get_training(logits, labels,
                                        sequence_length,
                                        scope, learning_rate,
                                        decay_steps, decay_rate,
-                                       decay_staircase, momentum)
+                                       decay_staircase, momentum,
+                                       backbone)
 
         # Initialize weights from a pre-trained model
         # NOTE: Does not work when num_gpus>1, cf. tensorflow issue 21615.
@@ -273,12 +283,13 @@ def train_fn(scope, tune_from, learning_rate,
     return train
 
 
-def evaluate_fn():
+def evaluate_fn(rnn_impl='dynamic', seq_head='rnn', backbone='convnet'):
     """Returns a function that evaluates the model for all batches at once or 
     continuously for one batch"""
 
     def evaluate(features, labels, mode, params):
-        logits, sequence_length = _get_image_info(features, mode)
+        logits, sequence_length = _get_image_info(features, mode, rnn_impl,
+                                                  seq_head, backbone)
 
         continuous_eval = params['continuous_eval']
         length = features['length']
@@ -354,7 +365,8 @@ def evaluate_fn():
 
 # Todo:
 # change here, Remove lexicon search, actually further modification is unnecessary, just pass None to lexicon.
-def predict_fn(lexicon):
+def predict_fn(lexicon, rnn_impl='dynamic', seq_head='rnn',
+               backbone='convnet'):
     """Returns a function that runs the model on the input data 
        (e.g., for validation)"""
 
@@ -370,7 +382,9 @@ def predict_fn(lexicon):
         # Pack the modified image data into a dictionary
         proc_img_data = {'image': proc_image, 'width': width}
 
-        logits, sequence_length = _get_image_info(proc_img_data, mode)
+        logits, sequence_length = _get_image_info(proc_img_data, mode,
+                                                  rnn_impl, seq_head,
+                                                  backbone)
 
         prediction, log_prob = _get_output(logits, sequence_length, lexicon)
 
@@ -18,7 +18,10 @@
 
 import tensorflow as tf
 import numpy as np
+import hashlib
+import os
 import sys
+import recordindex
 
 def get_data( use_static_data,
               base_dir=None,
@@ -29,7 +32,19 @@ def get_data( use_static_data,
               num_epochs=None,
               filter_fn=None,
               synth_config_file=None,
-              use_ipc_synth=True ):
+              use_ipc_synth=True,
+              store_dir=None,
+              token_budget=None,
+              num_buckets=8,
+              stats=False,
+              autotune=False,
+              seed=None,
+              shuffle_records=False,
+              cache=False,
+              cache_dir=None,
+              cache_budget_mb=1024,
+              echo_factor=1,
+              echo_level='example' ):
     """Get Dataset according to parameters
     Parameters:
       use_static_data   : boolean for whether to use static or dynamic data
@@ -37,11 +52,43 @@ def get_data( use_static_data,
       file_patterns     : string for static data patterns  (static data only)
       num_threads       : number of threads to use for IO / preprocessing
       batch_size        : number of images to use in each batch 
-      boundaries        : boundaries for bucketing. If None, no bucketing used
+      boundaries        : boundaries for bucketing. If None, no bucketing used.
+                          If 'auto', computed from the width distribution
+                          in the shard indexes (static data only)
       num_epochs        : if None, data repeats infinitely (static data only)
       filter_fn         : filtering function
       synth_config_file : string for synthesizer config file (dynamic data only)
       use_ipc_synth:    : boolean for IPC versus single-thread synthesizer
+      store_dir         : string for a memory-mapped image store to read 
+                          instead of TFRecord files (static data only)
+      token_budget      : if given, each bucket's batch size is this number
+                          of padded image columns divided by the bucket's
+                          widest image, instead of batch_size
+      num_buckets       : number of buckets when boundaries is 'auto'
+      stats             : boolean for recording per-stage latency (read, 
+                          parse, filter, bucket, postbatch) and prefetch 
+                          buffer occupancy as summaries
+      autotune          : boolean for letting tf.data tune the parallelism
+                          and prefetch depth of each stage from its own
+                          measurements, instead of num_threads
+      seed              : seed for shuffling, so that a checkpointed input
+                          position can be restored (TFRecord data only)
+      shuffle_records   : boolean for reading the records of all TFRecord 
+                          files in a globally random order, located through 
+                          the shard indexes, instead of shuffling only the 
+                          file order (uncompressed TFRecord data only)
+      cache             : boolean for caching the decoded examples after the
+                          first epoch, so later epochs skip reading and 
+                          decoding (static data only)
+      cache_dir         : directory for a cache file, used when the decoded
+                          examples are estimated to exceed cache_budget_mb
+      cache_budget_mb   : largest cache to keep in memory, in MB
+      echo_factor       : number of times each decoded example (or batch)
+                          is used, with fresh brightness/contrast jitter, 
+                          before new data is fetched. 1 turns echoing off
+      echo_level        : 'example' to echo examples before batching (and
+                          mix the copies by a shuffle) or 'batch' to echo
+                          whole batches
                       
     Returns:
       dataset : tf.data.Dataset object.
@@ -52,16 +99,36 @@ def get_data( use_static_data,
     # Elements to be buffered
     num_buffered_elements = num_threads * batch_size * 2
 
+    # Parallelism of the map stages
+    num_parallel_calls = tf.contrib.data.AUTOTUNE if autotune else num_threads
+
+    def prefetch( dataset, stage, buffer_size ):
+        """Close a stage: record its stats and buffer its output"""
+        if stats:
+            dataset = dataset.apply( tf.contrib.data.latency_stats( 
+                'input/' + stage ) )
+        if autotune:
+            buffer_size = tf.contrib.data.AUTOTUNE
+        return dataset.prefetch( buffer_size )
+
     # Get correct import and args for given pipeline
     # `dpipe` will be a variable for the package name
-    if use_static_data:
+    if use_static_data and store_dir:
+        # Pre-decoded images, see imagestore.py
+        import imagestore as dpipe
+        dpipe_args = ( store_dir,
+                       num_threads,
+                       num_buffered_elements )
+    elif use_static_data:
         import mjsynth as dpipe
         dpipe_args = ( base_dir, 
                        file_patterns, 
                        num_threads, 
-                       num_buffered_elements )
+                       num_buffered_elements,
+                       seed,
+                       shuffle_records )
     else:
-        # For dynamic data only -- refer to README.md for additional instructions
+        # For dynamic data only -- see maptextsynth.py for the config file
         import maptextsynth as dpipe
 
         # Ensure synth_config_file is specified
@@ -69,7 +136,7 @@ def get_data( use_static_data,
             sys.stderr.write("Dynamic data pipeline requires synth_config_file.")
             sys.exit(1)
             
-        # num_producers=0 uses single-threaded, nonbuffered synthesizer
+        # num_producers=0 renders in the input thread, without the ring buffer
         num_producers = num_threads if use_ipc_synth else 0
         
         dpipe_args = ( synth_config_file,
@@ -77,25 +144,84 @@ def get_data( use_static_data,
 
     # Get raw data
     dataset = dpipe.get_dataset( dpipe_args )
-    dataset = dataset.prefetch( num_buffered_elements )
-    
-    # Preprocess data
-    dataset = dataset.map( dpipe.preprocess_fn, 
-                           num_parallel_calls=num_threads )
-    dataset = dataset.prefetch( num_buffered_elements )
+    dataset = prefetch( dataset, 'read', num_buffered_elements )
     
-    # Remove input that doesn't fit necessary specifications
-    if filter_fn:
+    # Cache only static data; it is repeated, dynamic data is not
+    cache = cache and use_static_data
+
+    if filter_fn and hasattr( dpipe, 'decode_fn' ) and not cache:
+        # Push the filter down between parsing and decoding, so records
+        # that are filtered out are never decoded
+        dataset = dataset.map( dpipe.parse_fn, 
+                               num_parallel_calls=num_parallel_calls )
         dataset = dataset.filter( filter_fn )
-        dataset = dataset.prefetch( num_buffered_elements )
+        dataset = prefetch( dataset, 'filter', num_buffered_elements )
+        dataset = dataset.map( dpipe.decode_fn, 
+                               num_parallel_calls=num_parallel_calls )
+        dataset = prefetch( dataset, 'parse', num_buffered_elements )
+    else:
+        # Preprocess data
+        dataset = dataset.map( dpipe.preprocess_fn, 
+                               num_parallel_calls=num_parallel_calls )
+        dataset = prefetch( dataset, 'parse', num_buffered_elements )
+
+        if cache:
+            # Cache before filtering, so the cache does not depend on the
+            # filter; the filter only looks at metadata and is cheap
+            dataset = _cache( dataset, base_dir, file_patterns, store_dir,
+                              cache_dir, cache_budget_mb )
+            # The cache replays the first epoch's order, so shuffle again
+            dataset = dataset.shuffle( buffer_size=num_buffered_elements * 8,
+                                       seed=seed,
+                                       reshuffle_each_iteration=True )
+            dataset = prefetch( dataset, 'cache', num_buffered_elements )
+    
+        # Remove input that doesn't fit necessary specifications
+        if filter_fn:
+            dataset = dataset.filter( filter_fn )
+            dataset = prefetch( dataset, 'filter', num_buffered_elements )
+
+    if echo_level not in ( 'example', 'batch' ):
+        raise ValueError( 'Unknown echo_level: %s' % echo_level )
+    if echo_factor > 1:
+        tf.logging.info( 'Data echoing: each %s is used %d times' % 
+                         ( echo_level, echo_factor ) )
+
+    if echo_factor > 1 and echo_level == 'example':
+        dataset = _echo( dataset, echo_factor, stats )
+        # Spread the copies of an example over different batches
+        dataset = dataset.shuffle( buffer_size=num_buffered_elements,
+                                   seed=seed,
+                                   reshuffle_each_iteration=True )
+        dataset = prefetch( dataset, 'echo', num_buffered_elements )
 
     # Bucket and batch appropriately
     if boundaries:
+        widths = None
+        if boundaries == 'auto' or token_budget:
+            widths = _get_widths( use_static_data, base_dir, file_patterns,
+                                  store_dir )
+        if boundaries == 'auto':
+            if widths is None:
+                raise ValueError( "boundaries='auto' requires indexed static data" )
+            boundaries = recordindex.bucket_boundaries( widths, num_buckets )
+        if token_budget:
+            if widths is None:
+                # Unknown data: assume the last bucket is twice as wide
+                max_width = 2 * boundaries[-1]
+            else:
+                max_width = int( np.max( widths ) )
+            bucket_batch_sizes = recordindex.bucket_batch_sizes( boundaries,
+                                                                 token_budget,
+                                                                 max_width )
+        else:
+            # Create numpy array as follows: [batch_size,...,batch_size]
+            bucket_batch_sizes = np.full( len( boundaries ) + 1, batch_size )
+        tf.logging.info( 'Bucket boundaries %s, batch sizes %s' %
+                         ( list( boundaries ), list( bucket_batch_sizes ) ) )
         dataset = dataset.apply( tf.contrib.data.bucket_by_sequence_length(
             element_length_func=dpipe.element_length_fn,
-            # Create numpy array as follows: [batch_size,...,batch_size]
-            bucket_batch_sizes=np.full( len( boundaries ) + 1, 
-                                        batch_size ),
+            bucket_batch_sizes=bucket_batch_sizes,
             bucket_boundaries=boundaries ) ) 
     else:
         # Dynamically pad batches to match largest in batch
@@ -105,7 +231,11 @@ def get_data( use_static_data,
     # Update to account for batching
     num_buffered_elements = num_threads * 2
     
-    dataset = dataset.prefetch( num_buffered_elements )
+    dataset = prefetch( dataset, 'bucket', num_buffered_elements )
+
+    if echo_factor > 1 and echo_level == 'batch':
+        dataset = _echo( dataset, echo_factor, stats )
+        dataset = prefetch( dataset, 'echo', num_buffered_elements )
     
     # Repeat for num_epochs  
     if num_epochs and use_static_data:
@@ -118,12 +248,124 @@ def get_data( use_static_data,
     # ie: sparsify labels for CTC operations (eg loss, decoder)
     # and convert elements to be [features, label]
     dataset = dataset.map( dpipe.postbatch_fn,
-                           num_parallel_calls=num_threads )
-    dataset = dataset.prefetch( num_buffered_elements )
+                           num_parallel_calls=num_parallel_calls )
+    dataset = prefetch( dataset, 'postbatch', num_buffered_elements )
+
+    if stats:
+        # Exported with the other summaries (e.g., by the Estimator)
+        aggregator = tf.contrib.data.StatsAggregator()
+        dataset = dataset.apply( 
+            tf.contrib.data.set_stats_aggregator( aggregator ) )
+        tf.add_to_collection( tf.GraphKeys.SUMMARIES, 
+                              aggregator.get_summary() )
     
     return dataset
 
 
+def _echo( dataset, echo_factor, stats=False ):
+    """Repeat each element echo_factor times, jittering every copy.
+    With stats, the element counts of input/echo_fresh and input/echo_out 
+    give the effective echo factor"""
+    if stats:
+        dataset = dataset.apply( tf.contrib.data.latency_stats( 
+            'input/echo_fresh' ) )
+    dataset = dataset.flat_map( 
+        lambda *element: tf.data.Dataset.from_tensors( element ).repeat( 
+            echo_factor ) )
+    dataset = dataset.map( lambda image, *rest: ( jitter_image( image ), ) 
+                           + rest )
+    if stats:
+        dataset = dataset.apply( tf.contrib.data.latency_stats( 
+            'input/echo_out' ) )
+    return dataset
+
+
+def jitter_image( image, max_brightness=0.1, contrast_range=( 0.7, 1.3 ) ):
+    """Random brightness and contrast of each image of image, an image 
+    [height, width, 1] or a batch of images [batch, height, width, 1] as 
+    rescaled by rescale_image"""
+    # One draw per image
+    if image.shape.ndims == 4:
+        shape = tf.concat( [ tf.shape( image )[:1], [1, 1, 1] ], 0 )
+    else:
+        shape = []
+    contrast = tf.random_uniform( shape, contrast_range[0], contrast_range[1] )
+    brightness = tf.random_uniform( shape, -max_brightness, max_brightness )
+    image = image * contrast + brightness
+    return tf.clip_by_value( image, -0.5, 0.5 )
+
+
+def _cache( dataset, base_dir, file_patterns, store_dir, cache_dir, 
+            budget_mb ):
+    """Cache the decoded examples in memory, or in a file of cache_dir when
+    they are estimated to exceed budget_mb. The file name carries a
+    signature of the data files, so changed shards get a new cache"""
+    widths = _get_widths( True, base_dir, file_patterns, store_dir )
+    if widths is None:
+        size_mb = None
+    else:
+        # Decoded images are float32 [32, width, 1]; labels etc. are small
+        size_mb = ( 32 * 4 * np.sum( widths, dtype=np.int64 ) 
+                    + 256 * len( widths ) ) / 2.0**20
+
+    if size_mb is not None and size_mb <= budget_mb:
+        tf.logging.info( 'Caching ~%.0f MB of decoded input in memory' % 
+                         size_mb )
+        return dataset.cache()
+    if not cache_dir:
+        tf.logging.warning( 'Input cache of ~%s MB exceeds the budget of %d MB'
+                            ' and no cache_dir is given; caching in memory' %
+                            ( '%.0f' % size_mb if size_mb else '?', 
+                              budget_mb ) )
+        return dataset.cache()
+
+    from manifest import stats_signature
+    if store_dir:
+        import imagestore
+        source = os.path.abspath( store_dir )
+        paths = [ os.path.join( store_dir, imagestore.INDEX_FILE ),
+                  os.path.join( store_dir, imagestore.IMAGES_FILE ) ]
+    else:
+        import mjsynth
+        source = os.path.abspath( base_dir ) + ' ' + ' '.join( file_patterns )
+        paths = mjsynth._get_filenames( base_dir, file_patterns )
+    # input-cache-<dataset>-<version of its files>: caches of other datasets
+    # may share cache_dir
+    prefix = 'input-cache-%s-' % \
+             hashlib.sha1( source.encode( 'utf-8' ) ).hexdigest()[:8]
+    filename = prefix + stats_signature( sorted( paths ) )[:16]
+    if not os.path.exists( cache_dir ):
+        os.makedirs( cache_dir )
+    names = os.listdir( cache_dir )
+    # A lockfile left by an interrupted run marks an unfinished cache, which
+    # tensorflow would refuse to overwrite: start it over
+    stale = any( name.startswith( filename ) and name.endswith( '.lockfile' )
+                 for name in names )
+    for name in names:
+        # Earlier versions of this dataset's cache, or an unfinished one
+        if name.startswith( prefix ) and \
+           ( stale or not name.startswith( filename ) ):
+            os.remove( os.path.join( cache_dir, name ) )
+    tf.logging.info( 'Caching decoded input in %s' % 
+                     os.path.join( cache_dir, filename ) )
+    return dataset.cache( os.path.join( cache_dir, filename ) )
+
+
+def _get_widths( use_static_data, base_dir, file_patterns, store_dir ):
+    """Image widths of the static data from its indexes, or None if unknown"""
+    if not use_static_data:
+        return None
+    if store_dir:
+        import imagestore
+        return imagestore.ImageStore( store_dir ).widths
+    try:
+        widths, _ = recordindex.load_indexes( base_dir, file_patterns )
+    except IOError:
+        tf.logging.warning( 'No shard indexes in %s' % base_dir )
+        return None
+    return widths
+
+
 def rescale_image( image ):
     """Rescale from uint8([0,255]) to float([-0.5,0.5])"""
     image = tf.image.convert_image_dtype( image, tf.float32 )
@@ -0,0 +1,196 @@
+# recordindex.py -- Sidecar indexes of TFRecord shards, for planning
+#   bucketing and filtering without scanning the records.
+#
+# gen_shard writes one index next to each shard (<shard>.index.npz) with
+# the byte offset, image width and label length of every record. Offsets
+# are positions in the uncompressed record stream.
+#
+#   python recordindex.py --input_dir ../data/train --boundaries 32,64,128
+
+import argparse
+import glob
+import os
+import struct
+import numpy as np
+
+INDEX_SUFFIX = '.index.npz'
+
+# Framing of each record: length (8 bytes), length crc (4), data, data crc (4)
+RECORD_OVERHEAD = 16
+
+
+def index_path( filename ):
+    """Sidecar index file name of a shard"""
+    return filename + INDEX_SUFFIX
+
+
+def is_index( filename ):
+    return filename.endswith( INDEX_SUFFIX )
+
+
+def write_index( filename, offsets, widths, lengths ):
+    """Write the sidecar index of a shard"""
+    np.savez( filename,
+              offsets=np.asarray( offsets, dtype=np.int64 ),
+              widths=np.asarray( widths, dtype=np.int32 ),
+              lengths=np.asarray( lengths, dtype=np.int32 ) )
+
+
+def load_index( shard ):
+    """Load the sidecar index of a shard as a dict of arrays"""
+    with np.load( index_path( shard ) ) as index:
+        return { key: index[key] for key in index.files }
+
+
+def get_shards( base_dir, file_patterns=['*.tfrecord'] ):
+    """Shards matching the patterns that have a sidecar index"""
+    shards = [ shard for pattern in file_patterns
+               for shard in sorted( glob.glob( os.path.join( base_dir, pattern ) ) )
+               if not is_index( shard ) and os.path.exists( index_path( shard ) ) ]
+    return shards
+
+
+def load_indexes( base_dir, file_patterns=['*.tfrecord'] ):
+    """Concatenated widths and label lengths of all indexed shards"""
+    indexes = [ load_index( shard ) for shard in get_shards( base_dir,
+                                                             file_patterns ) ]
+    if not indexes:
+        raise IOError( 'No indexed shards found in %s' % base_dir )
+    widths = np.concatenate( [ index['widths'] for index in indexes ] )
+    lengths = np.concatenate( [ index['lengths'] for index in indexes ] )
+    return widths, lengths
+
+
+class RecordReader( object ):
+    """Positioned reads of single records of uncompressed shards, located
+    through their indexes, so records can be read in any order"""
+
+    def __init__( self, shards ):
+        indexes = [ load_index( shard ) for shard in shards ]
+        self.shard_ids = np.concatenate(
+            [ np.full( len( index['offsets'] ), i, dtype=np.int32 )
+              for i, index in enumerate( indexes ) ] )
+        self.offsets = np.concatenate( [ index['offsets']
+                                         for index in indexes ] )
+        self.fds = [ os.open( shard, os.O_RDONLY ) for shard in shards ]
+
+    def __len__( self ):
+        return len( self.offsets )
+
+    def read( self, i ):
+        """Serialized record i (counting through all shards)"""
+        fd = self.fds[ self.shard_ids[i] ]
+        offset = int( self.offsets[i] )
+        # Skip the length and its crc, as TFRecordReader does after checking
+        length = struct.unpack( '<Q', os.pread( fd, 8, offset ) )[0]
+        data = os.pread( fd, length, offset + 12 )
+        if len( data ) != length:
+            raise IOError( 'Truncated record at offset %d (stale index?)' %
+                           offset )
+        return data
+
+    def close( self ):
+        for fd in self.fds:
+            os.close( fd )
+        self.fds = []
+
+
+def histogram( values, bin_width=32 ):
+    """Counts of values in bins [0,bin_width), [bin_width, 2*bin_width)..."""
+    counts = np.bincount( np.asarray( values ) // bin_width )
+    edges = np.arange( len( counts ) + 1 ) * bin_width
+    return counts, edges
+
+
+def padding_waste( widths, boundaries, batch_size, seed=0 ):
+    """Estimate the fraction of padded image columns when bucketing widths
+    with the given boundaries (as in bucket_by_sequence_length) and padding
+    each randomly drawn batch to its widest image"""
+    widths = np.asarray( widths, dtype=np.int64 )
+    rng = np.random.RandomState( seed )
+    buckets = np.searchsorted( boundaries or [], widths, side='right' )
+    padded = 0
+    for bucket in np.unique( buckets ):
+        bucket_widths = rng.permutation( widths[buckets == bucket] )
+        starts = np.arange( 0, len( bucket_widths ), batch_size )
+        batch_max = np.maximum.reduceat( bucket_widths, starts )
+        batch_len = np.diff( np.append( starts, len( bucket_widths ) ) )
+        padded += np.sum( batch_max * batch_len )
+    return 1.0 - float( np.sum( widths ) ) / max( padded, 1 )
+
+
+def bucket_boundaries( widths, num_buckets=8, multiple=4 ):
+    """Bucket boundaries at the width quantiles, so each bucket holds about
+    the same number of records (rounded up to a multiple of `multiple`)"""
+    if num_buckets < 2:
+        raise ValueError( 'num_buckets must be at least 2, got %d' % num_buckets )
+    quantiles = np.percentile( widths, np.linspace( 0, 100, num_buckets + 1 )[1:-1] )
+    boundaries = np.ceil( quantiles / multiple ).astype( np.int64 ) * multiple
+    return sorted( set( int( b ) for b in boundaries if b > 0 ) )
+
+
+def bucket_batch_sizes( boundaries, token_budget, max_width ):
+    """Batch size of each bucket so a batch pads to at most token_budget
+    image columns: the budget divided by the widest image of the bucket.
+    max_width : width of the widest image (bounds the last bucket)"""
+    upper = list( boundaries ) + [ max( [ max_width ] + list( boundaries ) ) ]
+    return np.array( [ max( 1, token_budget // width ) for width in upper ],
+                     dtype=np.int64 )
+
+
+def keep_mask( widths, lengths, min_width=None, max_width=None,
+               min_length=None, max_length=None, seq_len_fn=None ):
+    """Boolean mask of the records an input filter would keep.
+    seq_len_fn: optional width->sequence length function; if given, records
+                whose label is longer than the sequence are dropped"""
+    keep = np.ones( len( widths ), dtype=bool )
+    if min_width:
+        keep &= widths >= min_width
+    if max_width:
+        keep &= widths <= max_width
+    if min_length:
+        keep &= lengths >= min_length
+    if max_length:
+        keep &= lengths <= max_length
+    if seq_len_fn:
+        keep &= lengths <= seq_len_fn( widths )
+    return keep
+
+
+def count_filtered( widths, lengths, **filter_args ):
+    """Number of records an input filter would keep (see keep_mask)"""
+    return int( np.sum( keep_mask( widths, lengths, **filter_args ) ) )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Summarize the sidecar indexes of TFRecord shards' )
+    parser.add_argument( '--input_dir', default='../data/train/' )
+    parser.add_argument( '--filename_pattern', default='words-*' )
+    parser.add_argument( '--boundaries', default='32,64,96,128,160,192,224,256' )
+    parser.add_argument( '--batch_size', type=int, default=32 )
+    parser.add_argument( '--min_image_width', type=int, default=None )
+    parser.add_argument( '--max_image_width', type=int, default=None )
+    parser.add_argument( '--min_string_length', type=int, default=None )
+    parser.add_argument( '--max_string_length', type=int, default=None )
+    args = parser.parse_args()
+
+    widths, lengths = load_indexes( args.input_dir,
+                                    str.split( args.filename_pattern, ',' ) )
+    print( '%d records' % len( widths ) )
+    counts, edges = histogram( widths )
+    for count, start, end in zip( counts, edges[:-1], edges[1:] ):
+        print( 'width  %5d-%-5d %8d' % ( start, end - 1, count ) )
+    counts, edges = histogram( lengths, 4 )
+    for count, start, end in zip( counts, edges[:-1], edges[1:] ):
+        print( 'length %5d-%-5d %8d' % ( start, end - 1, count ) )
+    boundaries = [ int( b ) for b in str.split( args.boundaries, ',' ) if b ]
+    print( 'padding waste with boundaries %s: %.1f%%' %
+           ( boundaries, 100 * padding_waste( widths, boundaries,
+                                              args.batch_size ) ) )
+    print( 'kept by filter: %d' %
+           count_filtered( widths, lengths,
+                           min_width=args.min_image_width,
+                           max_width=args.max_image_width,
+                           min_length=args.min_string_length,
+                           max_length=args.max_string_length ) )
@@ -20,6 +20,8 @@ import tensorflow as tf
 import pipeline
 import filters
 import model_fn
+import model
+import backbones
 
 FLAGS = tf.app.flags.FLAGS
 
@@ -28,6 +30,12 @@ tf.app.flags.DEFINE_string( 'model','../data/model',
 
 tf.app.flags.DEFINE_integer( 'batch_size',2**9,
                              """Eval batch size""" )
+tf.app.flags.DEFINE_enum( 'backbone','convnet',backbones.names(),
+                          """Convolutional feature extractor""" )
+tf.app.flags.DEFINE_enum( 'seq_head','rnn',model.seq_heads,
+                          """Sequence model: BiLSTM or dilated 1-D convolutions""" )
+tf.app.flags.DEFINE_enum( 'rnn_impl','dynamic',model.rnn_impls,
+                          """LSTM implementation""" )
 
 tf.app.flags.DEFINE_string( 'test_path','../data/',
                             """Base directory for test/validation data""" )
@@ -56,7 +64,6 @@ def _get_input():
                 in mjsynth.py
     """
 
-    # WARNING: More than two filters causes SEVERE throughput slowdown
     filter_fn = filters.input_filter_fn \
                 ( min_image_width=FLAGS.min_image_width,
                   max_image_width=FLAGS.max_image_width,
@@ -92,7 +99,9 @@ def main(argv=None):
   
     # Initialize the classifier
     classifier = tf.estimator.Estimator( config = _get_config(),
-                                         model_fn=model_fn.evaluate_fn(), 
+                                         model_fn=model_fn.evaluate_fn(
+                                             FLAGS.rnn_impl, FLAGS.seq_head,
+                                             FLAGS.backbone ), 
                                          model_dir=FLAGS.model,
                                          params={'continuous_eval': False} )
     
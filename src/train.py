@@ -21,7 +21,9 @@ import os
 import tensorflow as tf
 import pipeline
 import model_fn
+import model
 import filters
+import backbones
 
 FLAGS = tf.app.flags.FLAGS
 
@@ -49,12 +51,56 @@ tf.app.flags.DEFINE_integer('max_num_steps', 2**21,
 tf.app.flags.DEFINE_integer('save_checkpoint_secs', 120,
                             """Interval between daving checkpoints""")
 
+tf.app.flags.DEFINE_enum('backbone','convnet',backbones.names(),
+                         """Convolutional feature extractor""")
+tf.app.flags.DEFINE_enum('seq_head','rnn',model.seq_heads,
+                         """Sequence model: 'rnn' (stacked BiLSTM) or
+                         'seqconv' (dilated 1-D convolutions)""")
+tf.app.flags.DEFINE_enum('rnn_impl','dynamic',model.rnn_impls,
+                         """LSTM implementation: 'dynamic' (cuDNN-compatible
+                         cell) or 'fused' (fused kernel, faster on CPU)""")
+
 tf.app.flags.DEFINE_integer('num_input_threads',2,
                           """Number of readers/generators for input data""")
+tf.app.flags.DEFINE_boolean('input_stats',False,
+                            """Export per-stage input pipeline statistics""")
+tf.app.flags.DEFINE_boolean('autotune_input',False,
+                            """Auto-tune input parallelism and prefetching""")
+tf.app.flags.DEFINE_boolean('checkpoint_input',False,
+                            """Save the input pipeline position with each
+                            checkpoint and resume from it on restart
+                            (static TFRecord data, one GPU only)""")
+tf.app.flags.DEFINE_boolean('shuffle_records',False,
+                            """Read records in a globally random order via
+                            the shard indexes (uncompressed shards only)""")
+tf.app.flags.DEFINE_boolean('cache_data',False,
+                            """Cache the decoded training examples after the
+                            first epoch (static data only)""")
+tf.app.flags.DEFINE_string('cache_dir',None,
+                           """Directory for the input cache file, used when
+                           the cache exceeds --cache_budget_mb""")
+tf.app.flags.DEFINE_integer('cache_budget_mb',1024,
+                            """Largest input cache to keep in memory (MB)""")
+tf.app.flags.DEFINE_integer('echo_factor',1,
+                            """Use each decoded example (or batch) this many
+                            times, with fresh jitter, when input-bound""")
+tf.app.flags.DEFINE_string('echo_level','example',
+                           """Data echoing of each 'example' or 'batch'""")
+tf.app.flags.DEFINE_integer('input_seed',None,
+                            """Seed for shuffling the input data
+                            (0 if not given with --checkpoint_input)""")
 tf.app.flags.DEFINE_integer('num_gpus', 1,
                             """Number of GPUs to use for distributed training""")
 tf.app.flags.DEFINE_boolean('bucket_data',True,
                             """Bucket training data by width for efficiency""")
+tf.app.flags.DEFINE_boolean('auto_buckets',False,
+                            """Derive bucket boundaries from the image widths
+                            in the shard indexes""")
+tf.app.flags.DEFINE_integer('num_buckets',8,
+                            """Number of buckets for --auto_buckets""")
+tf.app.flags.DEFINE_integer('token_budget',None,
+                            """Padded image columns per batch; sets each
+                            bucket's batch size instead of batch_size""")
 
 tf.app.flags.DEFINE_integer('min_image_width',None,
                             """Minimum allowable input image width""")
@@ -72,6 +118,9 @@ tf.app.flags.DEFINE_string('train_path','../data/train/',
                            """Base directory for training data""")
 tf.app.flags.DEFINE_string('filename_pattern','words-*',
                            """File pattern for input data""")
+tf.app.flags.DEFINE_string('store_dir',None,
+                           """Memory-mapped image store to train from instead
+                           of TFRecord files (see imagestore.py)""")
 
 tf.app.flags.DEFINE_string('synth_config_file', None,
                            """Location of config file for map text synthesizer""")
@@ -98,24 +147,37 @@ def _get_input():
                 data pipelines respectively
     """
 
-    # WARNING: More than two filters causes SEVERE throughput slowdown
     filter_fn = filters.input_filter_fn \
                 ( min_image_width=FLAGS.min_image_width,
                   max_image_width=FLAGS.max_image_width,
                   min_string_length=FLAGS.min_string_length,
                   max_string_length=FLAGS.max_string_length,
-                  check_input=(not FLAGS.static_data) )
+                  check_input=(not FLAGS.static_data),
+                  seq_len_fn=backbones.get_backbone( 
+                      FLAGS.backbone ).seq_len_fn )
     
     gpu_batch_size = FLAGS.batch_size // FLAGS.num_gpus
     
     # Pack keyword arguments into dictionary
     data_args = { 'num_threads': FLAGS.num_input_threads,
                   'batch_size': gpu_batch_size,
-                  'filter_fn': filter_fn }
+                  'filter_fn': filter_fn,
+                  'stats': FLAGS.input_stats,
+                  'autotune': FLAGS.autotune_input,
+                  'echo_factor': FLAGS.echo_factor,
+                  'echo_level': FLAGS.echo_level }
 
     if FLAGS.static_data: # Pack data stream-specific parameters
         data_args['base_dir'] = FLAGS.train_path
         data_args['file_patterns'] = str.split(FLAGS.filename_pattern, ',')
+        data_args['store_dir'] = FLAGS.store_dir
+        data_args['seed'] = FLAGS.input_seed
+        data_args['shuffle_records'] = FLAGS.shuffle_records
+        data_args['cache'] = FLAGS.cache_data
+        data_args['cache_dir'] = FLAGS.cache_dir
+        data_args['cache_budget_mb'] = FLAGS.cache_budget_mb
+        if FLAGS.checkpoint_input and FLAGS.input_seed is None:
+            data_args['seed'] = 0 # Restored order must match the saved one
     else:
         data_args['synth_config_file'] = FLAGS.synth_config_file
         data_args['use_ipc_synth'] = FLAGS.ipc_synth
@@ -125,6 +187,12 @@ def _get_input():
     elif not FLAGS.static_data: # Extra buckets for the wider synthetic data
         data_args['boundaries']=[32, 64, 96, 128, 160, 192, 224, 256,
                                  288, 320, 352, 384, 416, 448, 480, 512]
+    elif FLAGS.auto_buckets:
+        data_args['boundaries']='auto'
+        data_args['num_buckets']=FLAGS.num_buckets
+
+    if FLAGS.token_budget and FLAGS.bucket_data:
+        data_args['token_budget'] = FLAGS.token_budget // FLAGS.num_gpus
         
     # Get data according to flags
     dataset = pipeline.get_data( FLAGS.static_data, **data_args)
@@ -167,16 +235,31 @@ def main( argv=None ):
                   'decay_steps': FLAGS.decay_steps, 
                   'decay_rate': FLAGS.decay_rate, 
                   'decay_staircase': FLAGS.decay_staircase, 
-                  'momentum':FLAGS.momentum}
+                  'momentum':FLAGS.momentum,
+                  'rnn_impl':FLAGS.rnn_impl,
+                  'seq_head':FLAGS.seq_head,
+                  'backbone':FLAGS.backbone}
 
     # Initialize the classifier
     classifier = tf.estimator.Estimator( config=_get_config(), 
                                          model_fn=model_fn.train_fn(
                                              **train_args),
                                          model_dir=FLAGS.output )
+
+    hooks = None
+    if FLAGS.checkpoint_input:
+        # Iterator state can only be saved for the TFRecord pipeline
+        # (py_func and generator sources are not saveable)
+        if not FLAGS.static_data or FLAGS.store_dir or FLAGS.num_gpus > 1 \
+           or FLAGS.shuffle_records:
+            raise ValueError( '--checkpoint_input requires static TFRecord '
+                              'data on one GPU, without --shuffle_records' )
+        # Saves the iterator with every checkpoint and restores it on start
+        hooks = [tf.contrib.data.CheckpointInputPipelineHook( classifier )]
    
     # Train the model
-    classifier.train( input_fn=_get_input, max_steps=FLAGS.max_num_steps )
+    classifier.train( input_fn=_get_input, max_steps=FLAGS.max_num_steps,
+                      hooks=hooks )
 
 if __name__ == '__main__':
     os.environ['CUDA_VISIBLE_DEVICES'] = '0'
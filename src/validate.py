@@ -23,6 +23,8 @@ from PIL import Image
 import tensorflow as tf
 
 import model_fn
+import model
+import backbones
 import charset
 from lexicon import dictionary_from_file
 
@@ -34,6 +36,12 @@ tf.app.flags.DEFINE_string( 'model','../data/model',
                             """Directory for model checkpoints""" )
 tf.app.flags.DEFINE_boolean( 'print_score', False,
                              """Print log probability scores with predictions""" )
+tf.app.flags.DEFINE_enum( 'backbone','convnet',backbones.names(),
+                          """Convolutional feature extractor""" )
+tf.app.flags.DEFINE_enum( 'seq_head','rnn',model.seq_heads,
+                          """Sequence model: BiLSTM or dilated 1-D convolutions""" )
+tf.app.flags.DEFINE_enum( 'rnn_impl','dynamic',model.rnn_impls,
+                          """LSTM implementation""" )
 tf.app.flags.DEFINE_string( 'lexicon','',
 			    """File containing lexicon of image words""" )
 
@@ -89,22 +97,22 @@ def main(argv=None):
     
     classifier = tf.estimator.Estimator( config=_get_config(),
                                          model_fn=model_fn.predict_fn(
-                                             FLAGS.lexicon), 
+                                             FLAGS.lexicon, FLAGS.rnn_impl,
+                                             FLAGS.seq_head, FLAGS.backbone), 
                                          model_dir=FLAGS.model )
     
     predictions = classifier.predict( input_fn=_get_input )
     
-    # Get all the predictions in string format
-    while True:
-        try:
-            results = next( predictions )
-            pred_str = charset.label_to_string( results['labels'] )
-            if FLAGS.print_score:
-                print(pred_str, results['score'][0])
-            else:
-                print(pred_str)
-        except StopIteration:
-            sys.exit()
+    results = list( predictions )
+
+    # Get all the predictions in string format with one batched lookup
+    pred_strs = charset.codec.decode_batch( [result['labels']
+                                              for result in results] )
+    for pred_str, result in zip( pred_strs, results ):
+        if FLAGS.print_score:
+            print(pred_str, result['score'][0])
+        else:
+            print(pred_str)
     
 if __name__ == '__main__':
     tf.app.run()
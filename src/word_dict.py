@@ -1,15 +1,26 @@
 # coding:UTF-8
-from config import log, WORDDICT
+from config import log, CHARSET_FILE
+from manifest import stats_signature
+import json
 import os
 
-def load_dict():
+TEXT_DIR = '../data/originData/txt_train'
+
+
+def _signature(text_dir):
+    """Signature of the annotation files (names, sizes and mtimes)"""
+    return stats_signature([os.path.join(text_dir, txtname)
+                            for txtname in sorted(os.listdir(text_dir))])
+
+
+def scan_dict(text_dir=TEXT_DIR):
+    """Collect every character of the annotation files, in sorted order"""
     # words = []
     # with open(WORDDICT, 'r', encoding="utf-8") as f:
     #     for line in f.readlines():
     #         log.debug('Char: %s' % (line.strip(),))
     #         words.append(line)
     # log.info('Count %s characters!' %(len(words), ))
-    text_dir = '../data/originData/txt_train'
     words = set()
     for txtname in os.listdir(text_dir):
         with open(text_dir + '/' + txtname, 'r', encoding="utf-8") as f:
@@ -22,9 +33,55 @@ def load_dict():
                 # log.debug('textSet now: %s' % (textSet,))
     log.info('%s char found.' % (len(words),))
 
+    # Sort so label indices do not depend on the hash seed of the process
+    return sorted(words)
+
+
+def _load_compiled(charset_file):
+    if not os.path.exists(charset_file):
+        return None
+    with open(charset_file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def compile_dict(text_dir=TEXT_DIR, charset_file=CHARSET_FILE):
+    """Scan the annotation files and write the compiled charset file.
+
+    The charset only grows: characters of an existing charset file keep
+    their order (their indices are the labels of built shards and trained
+    checkpoints), new ones are appended in sorted order.
+    """
+    signature = _signature(text_dir)
+    compiled = _load_compiled(charset_file)
+    words = compiled['charset'] if compiled is not None else []
+    known = set(words)
+    new_words = [word for word in scan_dict(text_dir) if word not in known]
+    words = words + new_words
+    tmp_file = charset_file + '.tmp'
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        json.dump({'signature': signature, 'charset': words}, f, ensure_ascii=False)
+    os.replace(tmp_file, charset_file)
+    log.info('Compiled charset of %s chars (%s new) to %s' % (len(words), len(new_words), charset_file))
     return words
 
 
+def load_dict(text_dir=TEXT_DIR, charset_file=CHARSET_FILE):
+    """Load the charset as a list in a stable order.
+
+    The compiled charset file is rebuilt when the annotation files change.
+    Without the annotation files (e.g. on a training-only machine) the
+    compiled file is used as is.
+    """
+    compiled = _load_compiled(charset_file)
+    if not os.path.isdir(text_dir):
+        if compiled is None:
+            raise IOError('Neither %s nor %s found' % (charset_file, text_dir))
+        return compiled['charset']
+    if compiled is not None and compiled['signature'] == _signature(text_dir):
+        return compiled['charset']
+    return compile_dict(text_dir, charset_file)
+
+
 if __name__ == '__main__':
-    words= load_dict()
+    words= compile_dict()
     assert '1' in words